@@ -0,0 +1,89 @@
+"""Microbenchmark of calculations.calculate_scores
+
+Compares the array kernel with the former row by row implementation on
+synthetic submissions, and checks that the AbilityScore values are equal.
+
+Usage: python bench_scores.py [rows] [days]
+"""
+import math
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.append('../group2api/utils')
+
+from calculations import calculate_scores
+
+
+def reference_scores(data):
+    """The former iterrows implementation of calculate_scores"""
+
+    def getU(D, U):
+        U = U - (1/40) + ((1/30) * D)
+        if U <= 0:
+            return 0
+        return U
+
+    def computeHSHSscore(x_ij, d_i, t_ij):
+        if t_ij == None:
+            return None
+        a_i = 1 / d_i
+        return (2 * x_ij - 1) * (a_i * d_i - a_i * t_ij)
+
+    def computeDevFromExp(K, U):
+        if U == 0:
+            return 0.0075
+        return K * (1 + 4 * U - .5 * U)
+
+    def getExpectedScore(d_i, theta_j, beta_i):
+        a_i = 1 / d_i
+        div1 = (math.exp(2 * a_i * d_i * (theta_j - beta_i)) + 1)
+        div2 = math.exp(2 * a_i * d_i * (theta_j - beta_i))
+        return a_i * d_i * (div1 / div2 - 1) - (1 / (theta_j - beta_i))
+
+    data = pd.DataFrame(data)
+    data['SubmitDateTime'] = pd.to_datetime(data['SubmitDateTime'])
+    unique_dates = sorted(list({item.date() for item in data['SubmitDateTime']}))
+    D = [0] + [(unique_dates[u+1] - unique_dates[u]).days
+               for u in range(0, len(unique_dates) - 1)]
+    data['D'] = [D[unique_dates.index(date_time_obj.date())]
+                 for date_time_obj in data["SubmitDateTime"]]
+    U = 1
+    K = 0.01
+    SSSS = []
+    for i, row in data.iterrows():
+        U = getU(row['D'], U)
+        computeHSHSscore(row['Correct'], 500, row['ResponseTime'])
+        K = computeDevFromExp(K, U)
+        SSSS.append(getExpectedScore(500, 0.00001, 1))
+    data['AbilityScore'] = SSSS
+    return data.to_dict(orient='records')
+
+
+def make_submissions(rows, days, seed=0):
+    rng = np.random.RandomState(seed)
+    start = np.datetime64('2018-06-04')
+    offsets = np.sort(rng.randint(0, days * 86400, rows))
+    dates = start + offsets.astype('timedelta64[s]')
+    return [{'_id': i,
+             'SubmitDateTime': pd.Timestamp(date).to_pydatetime(),
+             'Correct': int(rng.randint(0, 2)),
+             'ResponseTime': None if rng.rand() < .1 else float(rng.rand() * 60)}
+            for i, date in enumerate(dates)]
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    data = make_submissions(rows, days)
+
+    new = [item['AbilityScore'] for item in calculate_scores(data)]
+    old = [item['AbilityScore'] for item in reference_scores(data)]
+    print("identical AbilityScore: {}".format(new == old))
+
+    for name, func in [('kernel', calculate_scores),
+                       ('reference', reference_scores)]:
+        best = min(timeit.repeat(lambda: func(data), number=1, repeat=3))
+        print("{:>9}: {:.4f}s for {} rows".format(name, best, rows))
@@ -1,17 +1,27 @@
-from flask import Flask, request, Response, jsonify, render_template, send_from_directory
+from flask import Flask, request, Response, jsonify, render_template, send_from_directory, \
+    stream_with_context
 import os
 import sys
 import re
 sys.path.append('..')
 from datetime import datetime, timedelta
 import json
-from pymongo import MongoClient
 from functools import wraps
+from pymongo import ASCENDING, DeleteMany, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import json_util
 from flask_bootstrap import Bootstrap
 import hashlib, base64
+import threading
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    # Flask < 2.2 only knows app.json_encoder
+    DefaultJSONProvider = None
+
 
 try:
     from .utils import calculations as calc
@@ -23,22 +33,92 @@ try:
 except ImportError:
     from utils import moment as mo
 
+try:
+    from .utils.db import get_database
+except ImportError:
+    from utils.db import get_database
+
+try:
+    from .utils.jobs import JobRunner, no_progress
+except ImportError:
+    from utils.jobs import JobRunner, no_progress
+
+try:
+    from .utils.snapshot import SubmissionSnapshot
+except ImportError:
+    from utils.snapshot import SubmissionSnapshot
+
+try:
+    from .utils.validation import coerce_submission, parse_submit_datetime, to_int
+except ImportError:
+    from utils.validation import coerce_submission, parse_submit_datetime, to_int
+
+try:
+    from .utils.cache import TTLCache
+except ImportError:
+    from utils.cache import TTLCache
+
+try:
+    from .utils import indexes
+except ImportError:
+    from utils import indexes
+
 app = Flask(__name__)
+# Render SubmitDateTime dates the way the clients sent them. Flask 2.3 and
+# later ignore json_encoder, they take a JSON provider instead.
+if DefaultJSONProvider is None:
+    app.json_encoder = mo.MyEncoder
+else:
+    class JSONProvider(DefaultJSONProvider):
+
+        @staticmethod
+        def default(obj):
+            try:
+                return mo.MyEncoder().default(obj)
+            except TypeError:
+                return DefaultJSONProvider.default(obj)
+
+    app.json = JSONProvider(app)
 #Bootstrap(app)
 app.secret_key = "super secret key"
 
 # Connect to mongoLab
-client = MongoClient(os.environ['MONGO_HOST'], int(os.environ['MONGO_PORT']))
-db = client[os.environ['MONGO_DBNAME']]
-
-# Authentication is only needed for db in mLab servers
-# db.authenticate(os.environ['MONGO_DBUSER'], os.environ['MONGO_DBPASS'])
+db = get_database()
 
 submissions = db['submissions']
 users = db['users']
 coordinates = db['coordinates']
 flag_coordinates = db['flag_coordinates']
 
+# Columnar copy of the submissions, kept up to date incrementally. The m2m
+# routes read from it instead of the database when M2M_SNAPSHOT=1.
+submission_snapshot = SubmissionSnapshot(submissions, db['meta'])
+app.config['M2M_SNAPSHOT'] = os.environ.get('M2M_SNAPSHOT', '0') == '1'
+
+# Fast m2m coordinates per (UserId, LearningObjectiveId, Days), kept up to
+# date after writes so /fast_m2m and /fast_all only have to read them
+m2m_coordinates = db['m2m_coordinates']
+m2m_coordinates.create_index([('UserId', ASCENDING),
+                              ('LearningObjectiveId', ASCENDING),
+                              ('Days', ASCENDING)], unique=True)
+
+# Runs the long recomputes outside of the request, at most JOB_WORKERS at
+# a time. See /jobs for their state.
+jobs = JobRunner(max_workers=int(os.environ.get('JOB_WORKERS', 2)),
+                 logger=app.logger)
+
+# The m2m_coordinates updates get their own worker, so they never wait
+# behind a long recompute
+m2m_jobs = JobRunner(max_workers=1, logger=app.logger)
+# Keys waiting for that worker, so a read miss does not queue them twice
+m2m_queued = set()
+m2m_queued_lock = threading.Lock()
+
+# Credentials that passed check_auth recently. Every worker process has
+# its own cache, AUTH_CACHE_TTL bounds how long a removed user stays valid.
+auth_cache = TTLCache(maxsize=int(os.environ.get('AUTH_CACHE_SIZE', 1024)),
+                      ttl=float(os.environ.get('AUTH_CACHE_TTL', 300)))
+
 @app.route('/check_connection/')
 def check():
     return "Hmm"
@@ -78,6 +158,154 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
+# Number of documents per chunk of a streamed NDJSON response
+NDJSON_BATCH_SIZE = 1000
+
+# Page size when the client passes after without limit
+DEFAULT_PAGE_SIZE = 1000
+
+
+def wants_ndjson():
+    """True if the client asked for newline delimited JSON
+
+    Either with ``?format=ndjson`` or with an ``Accept: application/x-ndjson``
+    header.
+    """
+    return (request.args.get('format') == 'ndjson' or
+            'application/x-ndjson' in request.headers.get('Accept', ''))
+
+
+def encode_page_cursor(last_id):
+    """Turns the _id of the last document of a page into an opaque token"""
+    return base64.urlsafe_b64encode(json_util.dumps(last_id).encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(token):
+    """Inverse of encode_page_cursor, raises ValueError for a bad token"""
+    try:
+        return json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError("Invalid page cursor {}".format(token))
+
+
+def get_page_arguments():
+    """Reads the limit and after query parameters
+
+    Returns
+    -------
+    limit : int or None
+        None when the client does not page
+
+    after : any
+        The decoded _id to continue after, None for the first page
+    """
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    if limit is None and after is None:
+        return None, None
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError("limit should be a positive integer")
+    if after is not None:
+        after = decode_page_cursor(after)
+    return limit, after
+
+
+def ndjson_response(docs, headers=None):
+    """Streams documents as newline delimited JSON, NDJSON_BATCH_SIZE per chunk"""
+    def generate():
+        lines = []
+        for doc in docs:
+            lines.append(json.dumps(doc, cls=mo.MyEncoder))
+            if len(lines) >= NDJSON_BATCH_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers=headers)
+
+
+def list_response(collection, query, projection, order_by=None):
+    """Returns the documents matching a query as a JSON list, paged or streamed
+
+    When the client wants NDJSON, the documents are written one per line
+    while the cursor is read, NDJSON_BATCH_SIZE at a time, so the result is
+    never held in memory as a whole.
+
+    With ``?limit=<n>`` (and ``&after=<cursor>`` for the following pages)
+    the documents are returned in _id order, one page at a time, as
+    ``{"data": [...], "next": <cursor>}``. ``next`` is null on the last
+    page. Paging is keyset based, every page costs the same no matter how
+    far the client got. Paged NDJSON responses carry the next cursor in the
+    X-Next-Cursor header.
+
+    Pages are read in _id order, or in (order_by, _id) order when order_by
+    is given. A range query on order_by then stays on its own index
+    instead of sorting every matching document on _id.
+    """
+    try:
+        limit, after = get_page_arguments()
+    except ValueError as e:
+        return jsonify(error=str(e))
+    if limit is None:
+        cursor = collection.find(query, projection)
+        if not wants_ndjson():
+            return jsonify([d for d in cursor])
+        return ndjson_response(cursor.batch_size(NDJSON_BATCH_SIZE))
+
+    if order_by is None:
+        sort = [('_id', ASCENDING)]
+        if after is not None:
+            query = {'$and': [query, {'_id': {'$gt': after}}]}
+    else:
+        sort = [(order_by, ASCENDING), ('_id', ASCENDING)]
+        if after is not None:
+            if not (isinstance(after, list) and len(after) == 2):
+                return jsonify(error="Invalid page cursor {}".format(request.args['after']))
+            value, last_id = after
+            query = {'$and': [query, {'$or': [{order_by: {'$gt': value}},
+                                              {order_by: value, '_id': {'$gt': last_id}}]}]}
+    hide_id = projection.get('_id', 1) == 0
+    page_projection = dict((k, v) for k, v in projection.items() if k != '_id') or None
+    page = [d for d in collection.find(query, page_projection)
+            .sort(sort).limit(limit + 1)]
+    next_cursor = None
+    if len(page) > limit:
+        last = page[limit - 1]
+        next_cursor = encode_page_cursor(
+            last['_id'] if order_by is None else [last.get(order_by), last['_id']])
+    page = page[:limit]
+    if hide_id:
+        for doc in page:
+            del doc['_id']
+    if wants_ndjson():
+        return ndjson_response(page, headers={'X-Next-Cursor': next_cursor or ''})
+    return jsonify(data=page, next=next_cursor)
+
+
+def date_range(date):
+    """Query on SubmitDateTime for the submissions of one calendar day
+
+    Parameters
+    ----------
+    date : string or datetime
+        The day, strings in YYYY-MM-DD format
+
+    Returns
+    -------
+    query : dictionary
+        A $gte/$lt range, which can use the SubmitDateTime index
+    """
+    if not isinstance(date, datetime):
+        date = datetime.strptime(date, '%Y-%m-%d')
+    start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return {'$gte': start, '$lt': start + timedelta(1)}
+
+
 @app.route('/docs')
 def serve_docs():
     """Display the documentations
@@ -109,13 +337,32 @@ def get_user_list():
 
     Usage example : <hostname>/users
 
+    Can be paged with ?limit=<n>&after=<cursor>, ordered by user id, see
+    list_response.
+
     Returns
     -------
     users : list of integers
         The list of user ids
     """
-    user_list = submissions.distinct('UserId')
-    return jsonify(user_list)
+    try:
+        limit, after = get_page_arguments()
+    except ValueError as e:
+        return jsonify(error=str(e))
+    if limit is None:
+        user_list = submissions.distinct('UserId')
+        return jsonify(user_list)
+    # Matching and sorting on UserId before the $group lets it walk the
+    # UserId index from the cursor on
+    pipeline = []
+    if after is not None:
+        pipeline.append({'$match': {'UserId': {'$gt': after}}})
+    pipeline += [{'$sort': {'UserId': 1}},
+                 {'$group': {'_id': '$UserId'}},
+                 {'$sort': {'_id': 1}}, {'$limit': limit + 1}]
+    user_list = [u['_id'] for u in submissions.aggregate(pipeline)]
+    next_cursor = encode_page_cursor(user_list[limit - 1]) if len(user_list) > limit else None
+    return jsonify(data=user_list[:limit], next=next_cursor)
 
 
 @app.route('/login_users')
@@ -128,17 +375,20 @@ def get_user_login_info():
     Returns
     -------
     all_login_users : list of dictionaries
-        The list of user login information
+        The list of user login information. Can be streamed as NDJSON
+        or paged with ?limit=&after=, see list_response.
     """
-    loginusers = users.find({}, {'_id': 0})
-    all_login_users = [u for u in loginusers]
-    return jsonify(all_login_users)
+    return list_response(users, {}, {'_id': 0})
 
 @app.route('/showdays')
 @requires_auth
 def show_days():
-    days = submissions.find({}, {'_id' : 0, 'Days':1, 'UserId':1, 'LearningObjectiveId':1})
-    return jsonify([d for d in days])
+    """Lists the Days, UserId and LearningObjectiveId of every submission
+
+    Usage example : <hostname>/showdays?format=ndjson
+    """
+    return list_response(submissions, {},
+                         {'_id' : 0, 'Days':1, 'UserId':1, 'LearningObjectiveId':1})
 
 
 @app.route('/login_users/username=<username>')
@@ -158,9 +408,7 @@ def get_user_login_info_with_user(username):
     login_user : list
         User login information
     """
-    login_user_info = users.find({'UserName': username}, {'_id': 0})
-    login_user = [u for u in login_user_info]
-    return jsonify(login_user)
+    return list_response(users, {'UserName': username}, {'_id': 0})
 
 @app.route('/get_data/date=<date>')
 @requires_auth
@@ -177,11 +425,14 @@ def get_data_by_date(date):
     Returns
     -------
     data : list
-        Returns list of instances belongs to the date
+        Returns list of instances belongs to the date. Can be streamed as
+        NDJSON or paged with ?limit=&after=, see list_response.
     """
-    data = submissions.find({'SubmitDateTime': {'$regex': '^' + date + '.*'}}, {'_id': 0})
-    data = [d for d in data]
-    return jsonify(data)
+    try:
+        query = {'SubmitDateTime': date_range(date)}
+    except ValueError:
+        return jsonify(error="Date should be in YYYY-MM-DD format.")
+    return list_response(submissions, query, {'_id': 0}, order_by='SubmitDateTime')
 
 @app.route('/get_data/day=<day_number>')
 @requires_auth
@@ -198,11 +449,10 @@ def get_data_by_day_number(day_number):
     Returns
     -------
     data : list
-        Returns list of instances belongs to one day
+        Returns list of instances belongs to one day. Can be streamed as
+        NDJSON or paged with ?limit=&after=, see list_response.
     """
-    data = submissions.find({'Days': int(day_number)}, {'_id': 0})
-    data = [d for d in data]
-    return jsonify(data)
+    return list_response(submissions, {'Days': int(day_number)}, {'_id': 0})
 
 @app.route('/scores/day=<day_number>&user_id=<user_id>&learning_obj_id=<learning_obj_id>')
 @requires_auth
@@ -226,33 +476,74 @@ def get_ability_score_by_day_number(day_number, user_id, learning_obj_id):
     Returns
     -------
     scores : an integer
-        The ability score achieved by the user
+        The ability score achieved by the user, the last one of the day
+        that is not NULL. 0 if there is none.
     """
-    scores = submissions.find(
-        {'Days': int(day_number),
-         'UserId': int(user_id),
-         'LearningObjectiveId': int(learning_obj_id)},
-        {'_id': 0, 'AbilityAfterAnswer': 1, 'SubmitDateTime': 1})
-    
-    datetime_list = []
-    data = [d for d in scores]
-    
-    for i in data:
-        try:
-            datetime_list.append(datetime.strptime(i['SubmitDateTime'], '%Y-%m-%d %H:%M:%S.%f'))
-        except ValueError:
-            datetime_list.append(datetime.strptime(i['SubmitDateTime'], '%Y-%m-%d %H:%M:%S'))
-    try:
-        index = datetime_list.index(max(datetime_list))
-    except Exception:
+    query = {'Days': int(day_number),
+             'UserId': int(user_id),
+             'LearningObjectiveId': int(learning_obj_id),
+             'AbilityAfterAnswer': {'$nin': ['NULL', None]}}
+    latest = list(submissions.find(query, {'_id': 0, 'AbilityAfterAnswer': 1})
+                  .sort('SubmitDateTime', -1).limit(1))
+    if not latest:
         return jsonify([0])
+    return jsonify([latest[0]['AbilityAfterAnswer']])
+
+
+@app.route('/scores/latest', methods=['POST'])
+@requires_auth
+def get_latest_ability_scores():
+    """Returns the last ability score of many users at once
+
+    The same as /scores/day=... for every posted (UserId,
+    LearningObjectiveId, Days) triple, computed in one aggregation.
+    Usage example with Python requests library::
+
+        import requests
+        data = [{"UserId": 231412, "LearningObjectiveId": 65745, "Days": 1},
+                {"UserId": 231413, "LearningObjectiveId": 65745, "Days": 1}]
+        requests.post("<hostname>/scores/latest", json=data)
+
+    Returns
+    -------
+    scores : list
+        The posted triples in the same order, each with its
+        AbilityAfterAnswer, 0 if there is none
+    """
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify(error="Post a list of UserId, LearningObjectiveId and Days")
     try:
-        while (data[index]['AbilityAfterAnswer'] == 'NULL'):
-            datetime_list.pop(index)
-            index = datetime_list.index(max(datetime_list))
-    except Exception:
-        return jsonify([0])
-    return jsonify([data[index]['AbilityAfterAnswer']])
+        triples = [tuple(to_int(item[field], field) for field in
+                         ('UserId', 'LearningObjectiveId', 'Days'))
+                   for item in data]
+    except (KeyError, TypeError) as e:
+        return jsonify(error="Every item needs UserId, LearningObjectiveId "
+                             "and Days: {}".format(e))
+    except ValueError as e:
+        return jsonify(error=str(e))
+    if not triples:
+        return jsonify([])
+
+    pipeline = [
+        {'$match': {'$or': [{'UserId': u, 'LearningObjectiveId': l, 'Days': d}
+                            for u, l, d in set(triples)],
+                    'AbilityAfterAnswer': {'$nin': ['NULL', None]}}},
+        # All ascending, in the order of the index, so the sort is an
+        # index scan and the latest submission is the $last of a group
+        {'$sort': {'UserId': 1, 'LearningObjectiveId': 1, 'Days': 1,
+                   'SubmitDateTime': 1}},
+        {'$group': {'_id': {'UserId': '$UserId',
+                            'LearningObjectiveId': '$LearningObjectiveId',
+                            'Days': '$Days'},
+                    'AbilityAfterAnswer': {'$last': '$AbilityAfterAnswer'}}},
+    ]
+    latest = {(g['_id']['UserId'], g['_id']['LearningObjectiveId'],
+               g['_id']['Days']): g['AbilityAfterAnswer']
+              for g in submissions.aggregate(pipeline)}
+    return jsonify([{'UserId': u, 'LearningObjectiveId': l, 'Days': d,
+                     'AbilityAfterAnswer': latest.get((u, l, d), 0)}
+                    for u, l, d in triples])
 
 
 @app.route('/upload_login_users')
@@ -281,6 +572,7 @@ def upload_login_users():
         user_info['UserName'] = str(row['UserName'])+'Wo'
         user_info['Password'] = str(row['UserName']) + '!' 
         users.insert(user_info)
+    auth_cache.clear()
     #for uid in user_ids:
     #    hashed_password = generate_password_hash(str(uid) + "!", method='sha256')
     #    user_info = {}
@@ -301,6 +593,7 @@ def upload_auth_user():
     user_info['UserName'] = "Group2"
     user_info['Password'] = "Group2-1234" 
     users.insert(user_info)
+    auth_cache.clear()
     return jsonify(message="User for auth is generated")
 
 @app.route('/user/user_id=<user_id>')
@@ -318,13 +611,10 @@ def get_user_info(user_id):
     Returns
     -------
     user_info : list of dictionaries
-        The list of user's activities
+        The list of user's activities. Can be streamed as NDJSON
+        or paged with ?limit=&after=, see list_response.
     """
-    infos = submissions.find({'UserId': int(user_id)}, {'_id': 0})
-    users_info = []
-    for info in infos:
-        users_info.append(info)
-    return jsonify(users_info)
+    return list_response(submissions, {'UserId': int(user_id)}, {'_id': 0})
 
 
 @app.route('/exercises/user_id=<user_id>&learning_obj_id=<learning_obj_id>')
@@ -401,12 +691,27 @@ def get_ability_scores(user_id, learning_obj_id, exercise_id):
     return jsonify(scores_list)
  
 
+RESPONSE_TIME_USERS = 500
+
+
+def write_in_batches(collection, writes, batch_size=1000):
+    """Sends the write operations with unordered bulk_write calls"""
+    for start in range(0, len(writes), batch_size):
+        collection.bulk_write(writes[start:start + batch_size], ordered=False)
+
+
+def job_queued(job):
+    """The response of a route that queued a job"""
+    return jsonify(message="Job queued.", job_id=job.id,
+                   status='/jobs/{}'.format(job.id))
+
+
 @app.route('/response_time_enrichment/user_id=<user_id>')
 @requires_auth
 def response_time_enrichment(user_id='all'):
     """Calculates and adds the response time for each submission
 
-    .. todo:: Run only on the data that doesn't have any response time
+    For 'all' the work is queued as a job, the response holds its id.
 
     Parameters
     ----------
@@ -414,17 +719,69 @@ def response_time_enrichment(user_id='all'):
         Give the id of the user. If given 'all', runs for
         each unique user in the database.
     """
-    user_ids_list = submissions.distinct('UserId') if user_id == 'all' else [
-        user_id]
-    for user_id in user_ids_list:
-        user_subs = submissions.find({'UserId': int(user_id)},
-                                     {'_id': 1, 'SubmitDateTime': 1})
-        user_subs = [sub for sub in user_subs]
-        resp_time_enrich = calc.get_response_time(user_subs)
-        for item in resp_time_enrich:
-            submissions.update({'_id': item['_id']}, {
-                '$set': {'ResponseTime': item['ResponseTime']}})
-    return jsonify(message="Response times succesfully added.")
+    if user_id == 'all':
+        return job_queued(jobs.submit('response_time_enrichment',
+                                      enrich_response_times, 'all'))
+    return jsonify(enrich_response_times(user_id))
+
+
+def enrich_response_times(user_id='all', progress=no_progress):
+    """Adds the missing response times
+
+    Only the users with submissions that have no ResponseTime yet are
+    processed, RESPONSE_TIME_USERS at a time. Their response times are
+    computed in one go and only the missing or changed ones are written.
+
+    For 'all' only the submissions inserted since the previous run are
+    searched: the last _id it saw is kept in the meta collection, the same
+    high-water mark the submission snapshot uses.
+
+    Parameters
+    ----------
+    user_id : integer or string, (default='all')
+        The id of the user, or 'all'
+
+    progress : callable, optional
+        Called with the number of users done and the number of users
+
+    Returns
+    -------
+    response : dictionary
+        A success message and the number of updated submissions
+    """
+    query = {'ResponseTime': {'$exists': False}}
+    last_id = None
+    if user_id != 'all':
+        query['UserId'] = int(user_id)
+    else:
+        mark = db['meta'].find_one({'_id': 'response_time_enrichment'})
+        if mark is not None:
+            query['_id'] = {'$gt': mark['last_id']}
+        top = list(submissions.find({}, {'_id': 1}).sort('_id', -1).limit(1))
+        if top:
+            last_id = top[0]['_id']
+            query['_id'] = dict(query.get('_id', {}), **{'$lte': last_id})
+    user_ids_list = [u for u in submissions.distinct('UserId', query)
+                     if u is not None]
+    updated = 0
+    for start in range(0, len(user_ids_list), RESPONSE_TIME_USERS):
+        user_subs = list(submissions.find(
+            {'UserId': {'$in': user_ids_list[start:start + RESPONSE_TIME_USERS]}},
+            {'_id': 1, 'UserId': 1, 'SubmitDateTime': 1, 'ResponseTime': 1}))
+        stored = {sub['_id']: sub for sub in user_subs}
+        writes = [UpdateOne({'_id': item['_id']},
+                            {'$set': {'ResponseTime': item['ResponseTime']}})
+                  for item in calc.get_response_time(user_subs)
+                  if 'ResponseTime' not in stored[item['_id']] or
+                  stored[item['_id']]['ResponseTime'] != item['ResponseTime']]
+        write_in_batches(submissions, writes)
+        updated += len(writes)
+        progress(min(start + RESPONSE_TIME_USERS, len(user_ids_list)),
+                 len(user_ids_list))
+    if last_id is not None:
+        db['meta'].update_one({'_id': 'response_time_enrichment'},
+                              {'$set': {'last_id': last_id}}, upsert=True)
+    return {'message': "Response times succesfully added.", 'updated': updated}
 
 
 @app.route('/calculate_scores/user_id=<user_id>')
@@ -432,7 +789,9 @@ def response_time_enrichment(user_id='all'):
 def calculate_scores(user_id='all'):
     """Calculates the ability scores for the given user or for all
     
-    .. warning:: If run for all users, it takes a while
+    .. warning:: If run for all users, it takes a while, so the work is
+       queued as a job and the response holds its id. The job result is
+       the response below.
     
     Parameters
     ----------
@@ -445,12 +804,23 @@ def calculate_scores(user_id='all'):
     response : dictionary
         Contains a success message and a list of failed user ids.
     """
+    if user_id == 'all':
+        return job_queued(jobs.submit('calculate_scores', score_users, 'all'))
+    return jsonify(score_users(user_id))
+
+
+def score_users(user_id='all', progress=no_progress):
+    """Calculates and stores the ability scores, see calculate_scores
+
+    progress is called with the number of users done and the number of
+    users.
+    """
     response = {
         "message": "Calculated Ability scores succesfully added.",
         "failed_ids": []
     }
     user_ids_list = submissions.distinct('UserId') if user_id == 'all' else [user_id]
-    for user_id in user_ids_list:
+    for done, user_id in enumerate(user_ids_list, 1):
         user_subs = submissions.find({'UserId': int(user_id)},
                                      {'_id': 1, 'SubmitDateTime': 1,
                                       'ExerciseId': 1, 'ResponseTime': 1,
@@ -461,16 +831,28 @@ def calculate_scores(user_id='all'):
         except KeyError:
             response['failed_ids'].append(user_id)
         else:
-            for item in calculated_ability_score:
-                submissions.update({'_id':item['_id']}, {'$set': {'AbilityScore': item['AbilityScore']}})
-    return jsonify(response)
+            write_in_batches(submissions, [
+                UpdateOne({'_id': item['_id']},
+                          {'$set': {'AbilityScore': item['AbilityScore']}})
+                for item in calculated_ability_score])
+        progress(done, len(user_ids_list))
+    return response
 
 @app.route('/add_days/start=<start_date>&end=<end_date>')
 @requires_auth
 def add_days(start_date, end_date):
     """Adds the days information to the instances based on given interval
 
+    A submission on the start date gets Days 1, the next date Days 2 and
+    so on up to the end date. Submissions outside of the interval lose
+    their Days. All days are written with one bulk write of range updates.
+
     Usage example : <hostname>/add_days/start=2017-11-28&end=2017-12-04
+
+    After an upload, add ``?only_new=1`` to only number the submissions
+    that have no Days yet, leaving the rest of the collection untouched.
+
+    The work is queued as a job, the response holds its id.
     
     Parameters
     ----------
@@ -482,18 +864,87 @@ def add_days(start_date, end_date):
     """
     start_date = datetime.strptime(start_date, '%Y-%m-%d')
     end_date = datetime.strptime(end_date, '%Y-%m-%d')
-    
-    date_list = [((start_date + timedelta(n)).strftime('%Y-%m-%d'), 1)
+    only_new = request.args.get('only_new') == '1'
+    return job_queued(jobs.submit('add_days', number_days,
+                                  start_date, end_date, only_new))
+
+
+def number_days(start_date, end_date, only_new=False, progress=no_progress):
+    """Sets Days on the submissions between the two datetimes, see add_days"""
+    date_list = [(start_date + timedelta(n), n + 1)
                  for n in range(int((end_date - start_date).days)+1)]
+    new_filter = {'Days': {'$exists': False}} if only_new else {}
+
+    touched = None
+    if only_new:
+        pairs = submissions.aggregate([
+            {'$match': dict(new_filter, SubmitDateTime={
+                '$gte': start_date, '$lt': end_date + timedelta(1)})},
+            {'$group': {'_id': {'UserId': '$UserId',
+                                'LearningObjectiveId': '$LearningObjectiveId'}}}])
+        touched = [(p['_id']['UserId'], p['_id']['LearningObjectiveId'], None)
+                   for p in pairs
+                   if p['_id'].get('UserId') is not None and
+                   p['_id'].get('LearningObjectiveId') is not None]
+
+    writes = [UpdateMany(dict(new_filter, SubmitDateTime=date_range(date)),
+                         {'$set': {'Days': days}})
+              for date, days in date_list]
+    if not only_new:
+        writes.append(UpdateMany({'Days': {'$exists': True},
+                                  '$or': [{'SubmitDateTime': {'$lt': start_date}},
+                                          {'SubmitDateTime': {'$gte': end_date + timedelta(1)}},
+                                          {'SubmitDateTime': {'$not': {'$type': 'date'}}}]},
+                                 {'$unset': {'Days': 1}}))
+    if writes:
+        submissions.bulk_write(writes, ordered=False)
+    submission_snapshot.invalidate()
+    refresh_m2m_coordinates(touched)
+    progress(len(date_list), len(date_list))
     
-    submissions.update({}, {'$unset': {'Days': 1}}, multi=True)
+    return {'message': "Days added."}
 
-    for date, days in date_list:
-        submissions.update({'SubmitDateTime': {'$regex': '^' + date + '.*'}}, 
-                           {'$set': {'Days': days}}, 
-                           multi=True)
-    
-    return jsonify(message="Days added.")
+
+@app.route('/admin/indexes', methods=['GET', 'POST'])
+@requires_auth
+def admin_indexes():
+    """Compares the database indexes with the catalog in utils/indexes.py
+
+    GET only reports, POST also creates the missing indexes. Add
+    ``?drop_extra=1`` to a POST to drop the indexes that are not in the
+    catalog.
+
+    Usage example : <hostname>/admin/indexes
+
+    Returns
+    -------
+    report : dictionary
+        Per collection the missing, present, different and extra indexes,
+        and the route queries that the catalog does not cover
+    """
+    report = indexes.reconcile(db, dry_run=request.method == 'GET',
+                               drop_extra=request.args.get('drop_extra') == '1')
+    return jsonify(report)
+
+
+@app.route('/jobs')
+@app.route('/jobs/<job_id>')
+@requires_auth
+def job_status(job_id=None):
+    """State, progress and timing of the jobs queued by the routes
+
+    Usage example : <hostname>/jobs/<job id returned by the route>
+
+    Without a job id all remembered jobs are listed, oldest first.
+    """
+    if job_id is None:
+        return jsonify([job.to_dict() for job in
+                        sorted(jobs.list() + m2m_jobs.list(),
+                               key=lambda job: job.created_at)])
+    job = jobs.get(job_id) or m2m_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="No job with id {}".format(job_id))
+    return jsonify(job.to_dict())
 
 
 @app.route('/hotfix/secret=<s>')
@@ -501,6 +952,8 @@ def add_days(start_date, end_date):
 def hotfix(s):
     if s == "hotfix":
         submissions.remove({})
+        submission_snapshot.invalidate()
+        m2m_coordinates.delete_many({})
     return jsonify(message="hotfix cleared the data")
 
 
@@ -521,15 +974,38 @@ def insert():
                  "Correct":1,
                  "AbilityAfterAnswer":14143}]
         requests.post("<hostname>/insert", json=data)
+
+    For large uploads use the bulk mode, which validates every row first
+    (UserId and Correct have to be integers, SubmitDateTime a valid time)
+    and writes the valid ones in chunks of *chunk_size* (default 1000)::
+
+        requests.post("<hostname>/insert?mode=bulk&chunk_size=5000", json=data)
+
+    It answers with the number of inserted and rejected rows and the
+    index and reason of every rejected row.
     """
     data_ = request.get_json()
     if type(data_) is not list:
         return jsonify(error="Data should be a list format.")
+    if request.args.get('mode') == 'bulk':
+        try:
+            chunk_size = int(request.args.get('chunk_size', 1000))
+            if chunk_size < 1:
+                raise ValueError
+        except ValueError:
+            return jsonify(error="chunk_size should be a positive integer.")
+        result = bulk_insert(data_, chunk_size)
+        result['message'] = "Bulk insert finished."
+        return jsonify(result)
     try:
         for item in data_:
+            if 'SubmitDateTime' in item:
+                item['SubmitDateTime'] = parse_submit_datetime(item['SubmitDateTime'])
             submissions.insert_one(item)
     except Exception as e:
         return jsonify(error="Error during insertion to database\n{}".format(e))
+    finally:
+        refresh_m2m_coordinates(touched_m2m_keys(data_))
     
 #    try:
  #       response_time_enrichment(user_id='all')
@@ -548,6 +1024,48 @@ def insert():
         
     return jsonify(message="Data succesfully inserted and saved.")
     
+def bulk_insert(data, chunk_size=1000):
+    """Validates the submissions and inserts them in unordered chunks
+
+    Parameters
+    ----------
+    data : list
+        The posted submissions
+
+    chunk_size : int, optional (default=1000)
+        Number of documents per insert_many call
+
+    Returns
+    -------
+    result : dictionary
+        The number of inserted and rejected rows, and for every rejected
+        row its index in data and the reason
+    """
+    valid = []
+    rejected = []
+    for index, item in enumerate(data):
+        try:
+            valid.append((index, coerce_submission(item)))
+        except ValueError as e:
+            rejected.append({'index': index, 'error': str(e)})
+    inserted = 0
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        try:
+            inserted += len(submissions.insert_many([doc for _, doc in chunk],
+                                                    ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            inserted += e.details['nInserted']
+            for error in e.details['writeErrors']:
+                rejected.append({'index': chunk[error['index']][0],
+                                 'error': error['errmsg']})
+    refresh_m2m_coordinates(touched_m2m_keys([doc for _, doc in valid]))
+    rejected.sort(key=lambda r: r['index'])
+    return {'inserted': inserted,
+            'rejected': len(rejected),
+            'rejected_rows': rejected}
+
+
 def check_match(mystr, comp):
     def pad(s):
         if len(s) % 4 != 0:
@@ -569,9 +1087,18 @@ def check_match(mystr, comp):
 def check_auth(username, password):
     """This function is called to check if a username /
     password combination is valid.
+
+    Valid combinations are kept in auth_cache, so repeated requests with
+    the same credentials do not query the users collection. The cache only
+    stores a hash of the credentials.
     """
-    loggedin_user = users.find({'UserName': str(username), 'Password': str(password)})
-    if [u for u in loggedin_user]:
+    key = hashlib.sha256('{}\0{}'.format(username, password).encode('utf-8')).hexdigest()
+    if auth_cache.get(key):
+        return True
+    loggedin_user = users.find_one({'UserName': str(username), 'Password': str(password)},
+                                   {'_id': 1})
+    if loggedin_user is not None:
+        auth_cache.set(key, True)
         return True
     else: 
         return False
@@ -596,6 +1123,82 @@ def user_login(user_name, password):
 
 
 
+def find_answers(user_id, loid, day=None, date=None, fields=('Correct',),
+                 sort_by_time=False):
+    """Returns the submissions of a user on a learning objective
+
+    Reads from the submission snapshot when M2M_SNAPSHOT is set, otherwise
+    queries only the matching documents.
+
+    Parameters
+    ----------
+    user_id, loid : integer
+        Ids of the user and of the learning objective
+
+    day : integer, optional (default=None)
+        Only return the submissions of this Days value
+
+    date : datetime, optional (default=None)
+        Only return the submissions of this date
+
+    fields : tuple of strings, optional (default=('Correct',))
+        The fields to return
+
+    sort_by_time : bool, optional (default=False)
+        Order by SubmitDateTime instead of insertion order
+
+    Returns
+    -------
+    answers : list of dictionaries
+    """
+    if app.config['M2M_SNAPSHOT']:
+        columns, rows = submission_snapshot.select(user_id, loid, day=day, date=date,
+                                                   sort_by_time=sort_by_time)
+        return [dict((f, columns[f][i]) for f in fields) for i in rows]
+    query = {'UserId': user_id, 'LearningObjectiveId': loid}
+    if day is not None:
+        query['Days'] = day
+    if date is not None:
+        query['SubmitDateTime'] = date_range(date)
+    projection = dict([('_id', 0)] + [(f, 1) for f in fields])
+    answers = submissions.find(query, projection)
+    if sort_by_time:
+        answers = answers.sort('SubmitDateTime', 1)
+    return [a for a in answers]
+
+
+def find_class_answers(user_ids, loid, days=None, fields=('Correct',),
+                       sort_by_time=False):
+    """find_answers for several users, with one $in query, or one refresh
+    and one mask over the submission snapshot when M2M_SNAPSHOT is set
+
+    days is a list of Days values to return, None returns every day.
+
+    Returns
+    -------
+    answers : dictionary
+        Maps every user id to its list of submissions, users without
+        submissions are left out
+    """
+    if app.config['M2M_SNAPSHOT']:
+        columns, rows = submission_snapshot.select_users(
+            user_ids, loid, days=days, sort_by_time=sort_by_time)
+        return dict((user_id, [dict((f, columns[f][i]) for f in fields)
+                               for i in user_rows])
+                    for user_id, user_rows in rows.items())
+    query = {'UserId': {'$in': list(user_ids)}, 'LearningObjectiveId': loid}
+    if days is not None:
+        query['Days'] = {'$in': list(days)}
+    projection = dict([('_id', 0), ('UserId', 1)] + [(f, 1) for f in fields])
+    cursor = submissions.find(query, projection)
+    if sort_by_time:
+        cursor = cursor.sort('SubmitDateTime', 1)
+    answers = {}
+    for a in cursor:
+        answers.setdefault(a.pop('UserId'), []).append(a)
+    return answers
+
+
 @app.route('/calculate_m2m_coordinates/user_id=<user_id>/loid=<loid>')
 @app.route('/calculate_m2m_coordinates/user_id=<user_id>/loid=<loid>/date=<date>')
 @requires_auth
@@ -610,52 +1213,271 @@ def calculate_m2m_coordinates(user_id, loid, date=None):
     
     date : string, optional (default=None)
         pass in yyyy-mm-dd format. Will result in getting just the coordinates for that day
+
+    fitter : string, optional query parameter (default='smart_ssr')
+        Fitter used when the user has no precomputed parameters,
+        'smart_ssr' or 'em'. Usage example : ...?fitter=em
     
     Returns
     -------
     coords : The coordinates for which the
     """
-    submissiondata = submissions.find({}, {'_id': 0})
-    sub = [u for u in submissiondata]
-    handler = mo.DataHandler(sub)
-    if date is None:
-        coords = handler.get_coordinates_for_today(int(user_id), int(loid))
-    else:
+    fitter = request.args.get('fitter', 'smart_ssr')
+    if date is not None:
         date = mo.get_date_from_str(date)
-        coords = handler.get_coordinates_for_today(int(user_id), int(loid), date_id=date)
+    answers = [a['Correct'] for a in find_answers(int(user_id), int(loid), date=date)]
+    try:
+        coords = mo.coordinates_for_user(answers, int(user_id), int(loid), fitter)
+    except NotImplementedError:
+        return jsonify(error="Unknown fitter {}, use smart_ssr or em".format(fitter))
     return json.dumps(coords, cls=mo.MyEncoder)
 
+def get_day(submission):
+    """Returns the Days value of a submission as int, None if it has none"""
+    try:
+        return int(submission['Days'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def compute_m2m_coordinates(keys):
+    """Computes the fast coordinates of the keys
+
+    Only the m2m_jobs worker stores them (see store_m2m_coordinates), so a
+    read can never overwrite the coordinates of a refresh with older ones.
+
+    Parameters
+    ----------
+    keys : iterable of tuples
+        (UserId, LearningObjectiveId, Days) keys. Days may be None to
+        compute every day of the user on the learning objective.
+
+    Returns
+    -------
+    coordinates : dictionary
+        Maps every computed (UserId, LearningObjectiveId, Days) key to its
+        coordinates. Days without answers or without average parameters
+        are left out.
+    """
+    pairs = {}
+    for user_id, loid, day in keys:
+        pairs.setdefault((int(user_id), int(loid)), set()).add(day)
+    users_per_loid = {}
+    for user_id, loid in pairs:
+        users_per_loid.setdefault(loid, []).append(user_id)
+    sequences = {}
+    for loid, user_ids in users_per_loid.items():
+        # Only query the requested days, unless a key asks for all of them
+        days = set().union(*(pairs[(user_id, loid)] for user_id in user_ids))
+        answers = find_class_answers(user_ids, loid,
+                                     days=None if None in days else sorted(days),
+                                     fields=('Correct', 'Days'), sort_by_time=True)
+        for user_id, user_answers in answers.items():
+            days = pairs[(user_id, loid)]
+            for a in user_answers:
+                day = get_day(a)
+                if day is not None and (None in days or day in days):
+                    sequences.setdefault((user_id, loid, day), []).append(a['Correct'])
+    keys_per_day = {}
+    for key in sequences:
+        keys_per_day.setdefault(key[2], []).append(key)
+    coordinates = {}
+    for day, day_keys in keys_per_day.items():
+        try:
+            coords = mo.batch_fast_coordinates([sequences[k] for k in day_keys],
+                                               [day - 1] * len(day_keys))
+        except Exception as e:
+            app.logger.warning("No fast coordinates for day {}: {}".format(day, e))
+            continue
+        coordinates.update(zip(day_keys, coords))
+    return coordinates
+
+
+def store_m2m_coordinates(coordinates):
+    """Upserts the output of compute_m2m_coordinates into m2m_coordinates"""
+    now = datetime.utcnow()
+    writes = [UpdateOne({'UserId': user_id, 'LearningObjectiveId': loid, 'Days': day},
+                        {'$set': {'Coordinates': [float(c) for c in coords],
+                                  'UpdatedAt': now}},
+                        upsert=True)
+              for (user_id, loid, day), coords in coordinates.items()]
+    if writes:
+        m2m_coordinates.bulk_write(writes, ordered=False)
+
+
+def touched_m2m_keys(data):
+    """The (UserId, LearningObjectiveId, Days) keys of inserted submissions"""
+    keys = set()
+    for item in data:
+        try:
+            keys.add((int(item['UserId']), int(item['LearningObjectiveId']),
+                      int(item['Days'])))
+        except (KeyError, TypeError, ValueError):
+            # Without Days the key is only known after add_days
+            continue
+    return keys
+
+
+def refresh_m2m_coordinates(keys=None, delete=True):
+    """Recomputes m2m_coordinates in the background
+
+    Parameters
+    ----------
+    keys : iterable of tuples, optional (default=None)
+        The (UserId, LearningObjectiveId, Days) keys to recompute. None
+        rebuilds the whole collection.
+
+    delete : bool, optional (default=True)
+        Delete the stored coordinates of the keys right away, so until the
+        job has run (or when it is lost in a restart) the routes compute
+        them on read instead of returning outdated ones. The read routes
+        pass False for the keys they missed, keys that are already queued
+        are then left out.
+
+    The jobs run one at a time and read the submissions when they start,
+    so the last job to store a key ran after the last write to it.
+
+    Returns
+    -------
+    job : Job or None
+        The queued job, None if there was nothing to recompute
+    """
+    def run(keys, progress=no_progress):
+        if keys is not None:
+            with m2m_queued_lock:
+                m2m_queued.difference_update(keys)
+        if keys is None:
+            pairs = submissions.aggregate([{'$group': {'_id': {
+                'UserId': '$UserId', 'LearningObjectiveId': '$LearningObjectiveId'}}}])
+            keys = [(p['_id']['UserId'], p['_id']['LearningObjectiveId'], None)
+                    for p in pairs
+                    if p['_id'].get('UserId') is not None and
+                    p['_id'].get('LearningObjectiveId') is not None]
+        store_m2m_coordinates(compute_m2m_coordinates(keys))
+        progress(len(keys), len(keys))
+    if keys is not None:
+        with m2m_queued_lock:
+            keys = [k for k in keys if delete or k not in m2m_queued]
+            m2m_queued.update(keys)
+    if delete and keys is None:
+        m2m_coordinates.delete_many({})
+    elif delete and keys:
+        m2m_coordinates.bulk_write([
+            DeleteMany(dict([('UserId', user_id), ('LearningObjectiveId', loid)] +
+                            ([] if day is None else [('Days', day)])))
+            for user_id, loid, day in keys], ordered=False)
+    if keys is None or keys:
+        return m2m_jobs.submit('refresh_m2m_coordinates', run, keys)
+
+
 @app.route('/fast_m2m/user_id=<user_id>/loid=<loid>')
 @app.route('/fast_m2m/user_id=<user_id>/loid=<loid>/day=<day>')
 @requires_auth
 def fast_m2m(user_id, loid, day=None):
+    """Fast coordinates of the user on the learning objective for one day
+
+    Read from m2m_coordinates. If they are not there yet they are
+    computed, and stored by a refresh job.
+
+    Usage example : <hostname>/fast_m2m/user_id=1001/loid=8025/day=1
+    """
     if day is None:
         day = 1
-    submissiondata = submissions.find({}, {'_id': 0})
-    sub = [u for u in submissiondata]
-    answers = submissions.find({"UserId" : int(user_id), "LearningObjectiveId": int(loid), "Days": int(day)}, {'_id':0, "Correct":1})
-    answers = [a["Correct"] for a in answers]
-    coords = mo.DataHandler(sub).fast_coords_for_today(user_id, answers, int(day)-1)
+    key = (int(user_id), int(loid), int(day))
+    stored = m2m_coordinates.find_one(
+        {'UserId': key[0], 'LearningObjectiveId': key[1], 'Days': key[2]},
+        {'_id': 0, 'Coordinates': 1})
+    if stored is None:
+        coords = compute_m2m_coordinates([key]).get(key, [0.0])
+        refresh_m2m_coordinates([key], delete=False)
+    else:
+        coords = stored['Coordinates']
     if not coords[-1] == 0:
         coords.append(0.0)
     return json.dumps(coords, cls=mo.MyEncoder)
 
 
+@app.route('/fast_m2m', methods=['POST'])
+@requires_auth
+def fast_m2m_class():
+    """/fast_m2m for a whole class in one request
+
+    The stored coordinates of all users are read with one query, the
+    missing ones are computed together from one query on the submissions
+    and stored by a refresh job.
+    Usage example with Python requests library::
+
+        import requests
+        data = {"user_ids": [1001, 1002, 1003], "loid": 8025, "day": 1}
+        requests.post("<hostname>/fast_m2m", json=data)
+
+    Returns
+    -------
+    coords : dictionary
+        Maps every user id to its coordinates, as returned by /fast_m2m
+    """
+    data = request.get_json()
+    try:
+        user_ids = [to_int(u, 'user_ids') for u in data['user_ids']]
+        loid = to_int(data['loid'], 'loid')
+        day = to_int(data.get('day', 1), 'day')
+    except (KeyError, TypeError) as e:
+        return jsonify(error="Post user_ids, loid and optionally day: {}".format(e))
+    except ValueError as e:
+        return jsonify(error=str(e))
+
+    stored = m2m_coordinates.find(
+        {'UserId': {'$in': user_ids}, 'LearningObjectiveId': loid, 'Days': day},
+        {'_id': 0, 'UserId': 1, 'Coordinates': 1})
+    coords = dict((s['UserId'], s['Coordinates']) for s in stored)
+    missing = [(user_id, loid, day) for user_id in set(user_ids)
+               if user_id not in coords]
+    if missing:
+        computed = compute_m2m_coordinates(missing)
+        coords.update((user_id, computed.get((user_id, loid, day), [0.0]))
+                      for user_id, _, _ in missing)
+        refresh_m2m_coordinates(missing, delete=False)
+    for c in coords.values():
+        if not c[-1] == 0:
+            c.append(0.0)
+    ret = dict((str(user_id), coords[user_id]) for user_id in user_ids)
+    return Response(json.dumps(ret, cls=mo.MyEncoder), mimetype='application/json')
+
+
 @app.route('/fast_all/user_id=<user_id>/loid=<loid>')
 @requires_auth
 def fast_all(user_id, loid):
+    """Fast coordinates of every day the user worked on the learning objective
+
+    Usage example : <hostname>/fast_all/user_id=1001/loid=8025
+
+    The coordinates are the same as the ones of /fast_m2m for each day
+    (without the trailing 0) and are read from m2m_coordinates. Days of
+    the user that are not stored yet are computed, and stored by a
+    refresh job.
+
+    Returns
+    -------
+    coords : dictionary
+        Maps "coords_day<day>" to the coordinates of that day
+    """
     try:
-        ret = {}
-        submissiondata = submissions.find({}, {'_id': 0})
-        sub = [u for u in submissiondata]
-        days = [d for d in submissions.find({"UserId" : int(user_id), "LearningObjectiveId": int(loid)}).distinct('Days')]
-        for day in days:
-            answers = [a["Correct"] for a in submissions.find({"UserId" : int(user_id), "LearningObjectiveId": int(loid), "Days": int(day)}, {'_id':0, "Correct":1})]
-            coords = mo.DataHandler(sub).fast_coords_for_today(user_id, answers, day)
-            ret["coords_day{}".format(day)] = coords
+        stored = m2m_coordinates.find({'UserId': int(user_id), 'LearningObjectiveId': int(loid)},
+                                      {'_id': 0, 'Days': 1, 'Coordinates': 1})
+        coords = dict((s['Days'], s['Coordinates']) for s in stored)
+        days = submissions.distinct('Days', {'UserId': int(user_id),
+                                             'LearningObjectiveId': int(loid)})
+        missing = [(int(user_id), int(loid), day) for day in
+                   set(get_day({'Days': d}) for d in days) - set(coords)
+                   if day is not None]
+        if missing:
+            computed = compute_m2m_coordinates(missing)
+            coords.update((day, c) for (_, _, day), c in computed.items())
+            refresh_m2m_coordinates(missing, delete=False)
+        ret = {"coords_day{}".format(day): coords[day] for day in sorted(coords)}
     except Exception as e:
         return jsonify(message="Something went wrong {}".format(e))
-    return ret
+    return Response(json.dumps(ret, cls=mo.MyEncoder), mimetype='application/json')
 
 @app.route('/flag_positions')
 @requires_auth
@@ -663,12 +1485,19 @@ def flag_positions():
     """Generates a table for positon of flags
     
     Usage example : <hostname>/flag_positions
+
+    The work is queued as a job, the response holds its id.
     """
+    return job_queued(jobs.submit('flag_positions', generate_flag_positions))
+
+
+def generate_flag_positions(progress=no_progress):
+    """Adds the default flag positions of the users that have none yet"""
     users_user_ids = users.distinct('UserId')
-    coordinates_user_ids = coordinates.distinct('UserId')
+    coordinates_user_ids = set(coordinates.distinct('UserId'))
     user_ids = [uid for uid in users_user_ids if
                 uid not in coordinates_user_ids]
-    for uid in user_ids:
+    for done, uid in enumerate(user_ids, 1):
         user_info = {}
         user_info['UserId'] = uid
         user_info['Flag1'] = -1
@@ -678,7 +1507,8 @@ def flag_positions():
         user_info['Flag5'] = -1
         user_info['Flag6'] = -1
         coordinates.insert(user_info)
-    return jsonify(message="coordinates collection generated")
+        progress(done, len(user_ids))
+    return {'message': "coordinates collection generated"}
 
 @app.route('/list_flag_positions')
 @requires_auth
@@ -686,9 +1516,7 @@ def list_flag_positions():
     """lists the flags position table
     Usage example : <hostname>/list_flag_positions
     """
-    flagpos = coordinates.find({}, {'_id': 0})
-    all_user_flags = [u for u in flagpos]
-    return jsonify(all_user_flags)
+    return list_response(coordinates, {}, {'_id': 0})
 
 @app.route('/save_flag_position/user_id=<user_id>&flag=<flag_number>&flag_coord=<flag_coord>')
 @requires_auth
@@ -710,13 +1538,8 @@ def get_flag_position(user_id, flag_number):
     Usage example : <hostname>/get_flag_position/user_id=2345&flag=Flag1
     """    
         
-    flag_position = coordinates.find(
-        {'UserId': int(user_id)},
-        {'_id': 0, flag_number: 1})
-
-    flag_position = [f for f in flag_position]
-    
-    return jsonify(flag_position)
+    return list_response(coordinates, {'UserId': int(user_id)},
+                         {'_id': 0, flag_number: 1})
 
 ##### New Flag position operations
 
@@ -748,20 +1571,16 @@ def get_flag_position2(user_id, loid, flag_number='all'):
     Usage example : <hostname>/get_flag_position/user_id=2345&loid=8052&flag=Flag1
     """    
     if flag_number == 'all':
-        flag_positions = flag_coordinates.find(
-            {'UserId': int(user_id),
-             'LearningObjectiveId': int(loid)},
-            {'_id': 0})
+        projection = {'_id': 0}
     elif re.match(r'^Flag\d+', flag_number):
-        flag_positions = flag_coordinates.find(
-            {'UserId': int(user_id),
-             'LearningObjectiveId': int(loid)},
-            {'_id': 0, flag_number:1})
+        projection = {'_id': 0, flag_number:1}
     else:
         return jsonify(error="Flag key is not in the correct format. It should match with regex ^Flag\d+")
 
-    flag_positions = [f for f in flag_positions]
-    return jsonify(flag_positions)
+    return list_response(flag_coordinates,
+                         {'UserId': int(user_id),
+                          'LearningObjectiveId': int(loid)},
+                         projection)
     
 @app.route('/list_flag_positions2')
 @requires_auth
@@ -769,10 +1588,10 @@ def list_flag_positions2():
     """Lists the flags position table
     
     Usage example : <hostname>/list_flag_positions2
+
+    Can be streamed as NDJSON or paged with ?limit=&after=, see list_response.
     """
-    flagpos = flag_coordinates.find({}, {'_id': 0})
-    all_user_flags = [u for u in flagpos]
-    return jsonify(all_user_flags)
+    return list_response(flag_coordinates, {}, {'_id': 0})
 
 #@app.route('/save_flag_position/user_id=<user_id>&loid=<loid>&flag=<flag_number>&flag_coord=<flag_coord>')
 #def save_flag_position_by_learning_objective_id(user_id, loid, flag_number, flag_coord):
@@ -25,10 +25,10 @@ def upload_data(fname):
                 "AbilityAfterAnswer": aaa}
         data_dict_list.append(dict)
         print(dict, ",")
-    # r = requests.post(url=url + "insert/", json=data_dict_list[0],
+    # r = requests.post(url=url + "insert?mode=bulk", json=data_dict_list,
     #                   auth=("Group2", "Group2-1234"))
     # print(r.status_code, r.reason, url + "insert/")
-    r = requests.get(url + "add_days/start=2018-06-04&end=2018-06-0{}".format( str(day_of_month)), auth=("Group2", "Group2-1234"))
+    r = requests.get(url + "add_days/start=2018-06-04&end=2018-06-0{}?only_new=1".format( str(day_of_month)), auth=("Group2", "Group2-1234"))
     print(r.status_code, r.reason,
           url + "add_days/start=2018-06-04&end=2018-06-0{}".format(
               day_of_month))
@@ -0,0 +1,258 @@
+from collections import namedtuple
+
+import numpy as np
+
+
+# The four probabilities of a Bayesian Knowledge Tracing model: the skill
+# is known at the start (l0), gets learned after an answer (T), a wrong
+# skill still gives a correct answer (G) or a known skill a wrong one (S)
+BKTParameters = namedtuple('BKTParameters', ['l0', 'T', 'G', 'S'])
+
+DEFAULT_PARAMETERS = BKTParameters(l0=0.064, T=0.095, G=0.299, S=0.1)
+
+
+def calculate_ln(answers, parameters):
+    """Probability of the skill being learned after every answer
+
+    Parameters
+    ----------
+    answers : list,
+        The answer sequence, 1 for correct and 0 for wrong
+
+    parameters : BKTParameters or tuple,
+        (l0, T, G, S)
+
+    Returns
+    -------
+    p_ln : list,
+        One probability per answer
+    """
+    l0, T, G, S = parameters
+    p_ln = []
+    for answer_id in range(len(answers)):
+        if len(p_ln) == 0:
+            k = l0
+        else:
+            k = p_ln[-1]
+        s = S
+        g = G
+        if answers[answer_id] == 1:
+            ln_prev_given_res = (k * (1 - s)) / (
+            (k * (1 - s)) + ((1 - k) * g))
+        else:
+            ln_prev_given_res = (k * s) / ((k * s) + ((1 - k) * (1 - g)))
+        p_ln.append(ln_prev_given_res + (1 - ln_prev_given_res) * T)
+    return p_ln
+
+
+def calculate_p_j(answers, p_ln, parameters):
+    """Moment-by-moment learning probabilities of an answer sequence
+
+    Parameters
+    ----------
+    answers : list,
+        The answer sequence, 1 for correct and 0 for wrong
+
+    p_ln : list,
+        Output of calculate_ln for the same answers and parameters
+
+    parameters : BKTParameters or tuple,
+        (l0, T, G, S)
+
+    Returns
+    -------
+    p_j : list,
+        Two values less than there are answers
+    """
+    _, t, g, s = parameters
+    p_j = []
+    for a_id in range(len(answers) - 2):
+        p_l = p_ln[a_id]
+        p_nl_t = (1 - p_l) * t
+        x = (1 - p_l) * (1 - t)
+        if answers[a_id + 1] == 1:
+            if answers[a_id + 2] == 1:  # RR
+                a_ln = (1 - s) ** 2
+                a_n_ln_n_t = g * (1 - t) * g + g * t * (1 - s)
+            else:  # RW
+                a_ln = s * (1 - s)
+                a_n_ln_n_t = g * (1 - t) * (1 - g) + g * t * s
+        else:
+            if answers[a_id + 2] == 1:  # WR
+                a_ln = s * (1 - s)
+                a_n_ln_n_t = g * (1 - t) * (1 - g) + (1 - g) * t * (1 - s)
+            else:  # WW
+                a_ln = s ** 2
+                a_n_ln_n_t = (1 - g) * (1 - t) * (1 - g) + (1 - g) * t * s
+        a_n_ln_t = a_ln
+        a12 = p_l * a_ln + p_nl_t * a_n_ln_t + x * a_n_ln_n_t
+        p_j.append(a_n_ln_t * p_nl_t / a12)
+    return p_j
+
+
+def get_p_j(answers, parameters):
+    """calculate_ln followed by calculate_p_j
+
+    Returns
+    -------
+    p_ln, p_j : list,
+        See calculate_ln and calculate_p_j
+    """
+    p_ln = calculate_ln(answers, parameters)
+    return p_ln, calculate_p_j(answers, p_ln, parameters)
+
+
+def pad_sequences(sequences, fill_value=0):
+    """Stack ragged answer sequences into one padded 2-D array
+
+    Parameters
+    ----------
+    sequences : list of array-like,
+        The answer sequences, one per student (or per day)
+
+    fill_value : number, optional (default=0)
+        Value used for the positions after the end of a sequence
+
+    Returns
+    -------
+    padded : ndarray, shape (n_sequences, max_length)
+        The sequences left aligned, padded with fill_value
+
+    lengths : ndarray, shape (n_sequences,)
+        The original length of every sequence
+    """
+    lengths = np.array([len(seq) for seq in sequences], dtype=int)
+    width = lengths.max() if len(lengths) else 0
+    padded = np.full((len(sequences), width), fill_value, dtype=float)
+    mask = np.arange(width) < lengths[:, np.newaxis]
+    if mask.any():
+        padded[mask] = np.concatenate(
+            [np.asarray(seq, dtype=float) for seq in sequences])
+    return padded, lengths
+
+
+def _as_parameter_columns(parameters, n_sequences):
+    """Return l0, T, G and S as column vectors of length n_sequences
+
+    parameters is either one (l0, T, G, S) tuple shared by every sequence
+    or an array of shape (n_sequences, 4) with a row per sequence.
+    """
+    parameters = np.asarray(parameters, dtype=float)
+    parameters = np.broadcast_to(parameters, (n_sequences, 4))
+    return [parameters[:, i:i + 1] for i in range(4)]
+
+
+def batch_calculate_ln(answers, parameters):
+    """Vectorized counterpart of calculate_ln
+
+    Runs the forward pass for all sequences together: the loop goes over
+    the answer positions only, every sequence is updated at once.
+
+    Parameters
+    ----------
+    answers : ndarray, shape (n_sequences, max_length)
+        Padded answer sequences, see pad_sequences
+
+    parameters : tuple or ndarray,
+        Either one (l0, T, G, S) tuple or one row per sequence
+
+    Returns
+    -------
+    p_ln : ndarray, shape (n_sequences, max_length)
+        Probability of the skill being learned after every answer. The
+        values after the end of a sequence are meaningless.
+    """
+    answers = np.asarray(answers)
+    n_sequences, width = answers.shape
+    l0, T, G, S = [p[:, 0] for p in
+                   _as_parameter_columns(parameters, n_sequences)]
+    correct = answers == 1
+    p_ln = np.empty((n_sequences, width))
+    k = l0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for answer_id in range(width):
+            given_right = (k * (1 - S)) / ((k * (1 - S)) + ((1 - k) * G))
+            given_wrong = (k * S) / ((k * S) + ((1 - k) * (1 - G)))
+            ln_prev_given_res = np.where(correct[:, answer_id],
+                                         given_right, given_wrong)
+            k = ln_prev_given_res + (1 - ln_prev_given_res) * T
+            p_ln[:, answer_id] = k
+    return p_ln
+
+
+def batch_calculate_p_j(answers, p_ln, parameters):
+    """Vectorized counterpart of calculate_p_j
+
+    Parameters
+    ----------
+    answers : ndarray, shape (n_sequences, max_length)
+        Padded answer sequences, see pad_sequences
+
+    p_ln : ndarray, shape (n_sequences, max_length)
+        Output of batch_calculate_ln for the same answers
+
+    parameters : tuple or ndarray,
+        Either one (l0, T, G, S) tuple or one row per sequence
+
+    Returns
+    -------
+    p_j : ndarray, shape (n_sequences, max_length - 2)
+        Moment-by-moment learning probabilities. A sequence of length n
+        has n - 2 valid values.
+    """
+    answers = np.asarray(answers)
+    n_sequences, width = answers.shape
+    if width < 3:
+        return np.empty((n_sequences, 0))
+    _, t, g, s = _as_parameter_columns(parameters, n_sequences)
+    p_l = p_ln[:, :-2]
+    p_nl_t = (1 - p_l) * t
+    x = (1 - p_l) * (1 - t)
+    next_right = answers[:, 1:-1] == 1
+    after_right = answers[:, 2:] == 1
+
+    rr = next_right & after_right
+    rw = next_right & ~after_right
+    wr = ~next_right & after_right
+    a_ln = np.where(rr, (1 - s) ** 2,
+                    np.where(next_right | after_right, s * (1 - s), s ** 2))
+    a_n_ln_n_t = np.select(
+        [rr, rw, wr],
+        [g * (1 - t) * g + g * t * (1 - s),
+         g * (1 - t) * (1 - g) + g * t * s,
+         g * (1 - t) * (1 - g) + (1 - g) * t * (1 - s)],
+        (1 - g) * (1 - t) * (1 - g) + (1 - g) * t * s)
+    a_n_ln_t = a_ln
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a12 = p_l * a_ln + p_nl_t * a_n_ln_t + x * a_n_ln_n_t
+        return a_n_ln_t * p_nl_t / a12
+
+
+def batch_get_p_j(sequences, parameters):
+    """Compute p_ln and p_j for many ragged answer sequences at once
+
+    Parameters
+    ----------
+    sequences : list of array-like,
+        The answer sequences, one per student (or per day)
+
+    parameters : tuple or array-like,
+        Either one (l0, T, G, S) tuple used for every sequence, or a list
+        with one (l0, T, G, S) row per sequence
+
+    Returns
+    -------
+    p_ln : list of ndarray,
+        Learned probabilities per sequence, same lengths as the input
+
+    p_j : list of ndarray,
+        Moment-by-moment probabilities per sequence, two shorter than the
+        input (empty for sequences of less than three answers)
+    """
+    if len(sequences) == 0:
+        return [], []
+    answers, lengths = pad_sequences(sequences)
+    p_ln = batch_calculate_ln(answers, parameters)
+    p_j = batch_calculate_p_j(answers, p_ln, parameters)
+    return ([p_ln[i, :n] for i, n in enumerate(lengths)],
+            [p_j[i, :max(n - 2, 0)] for i, n in enumerate(lengths)])
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache():
+    """Small thread safe LRU cache whose entries expire after ttl seconds
+
+    Parameters
+    ----------
+    maxsize : int,
+        Maximum number of entries, the least recently used one is dropped
+        when it is exceeded
+
+    ttl : float,
+        Seconds an entry stays valid after it was set
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
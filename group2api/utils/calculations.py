@@ -1,138 +1,124 @@
+import numpy as np
 import pandas as pd
-import math
 import datetime
 
+try:
+    from .validation import to_datetime64
+except ImportError:
+    from validation import to_datetime64
+
+
 def get_response_time(data):
-    """Computes the response times for every answer except the first and last of the day"""
+    """Computes the response times for every answer except the first of the day
+
+    The answers are grouped per user (when UserId is given) and per date,
+    and every response time is the difference with the previous answer in
+    its group, in seconds. The first answer of a group gets None.
+    """
     data = pd.DataFrame(data)
-    data['SubmitDateTime'] = pd.to_datetime(data['SubmitDateTime'])
-    data = data.sort_values(by="SubmitDateTime").reset_index(drop=True)
-    unique_dates = sorted(list({date_time_obj.date() for date_time_obj in data['SubmitDateTime']}))
-    daily_df_list = []
-    for udate in unique_dates:
-        daily_data = data.loc[data["SubmitDateTime"].dt.date == udate]
-        daily_data = daily_data.reset_index(drop=True)
-        response_times = []
-        for i, row in daily_data.iterrows():
-            if i == 0:
-                response_times.append(None)
-            else:
-                response_times.append((row["SubmitDateTime"] - daily_data["SubmitDateTime"][i-1]).total_seconds())
-        daily_data['ResponseTime'] = response_times
-        daily_df_list.append(daily_data)
-    enriched_df = pd.concat(daily_df_list).reset_index(drop=True)
-    enriched_json = enriched_df.to_dict(orient='records')
+    data['SubmitDateTime'] = to_datetime64(data['SubmitDateTime'])
+    data = data.sort_values(by="SubmitDateTime", kind='mergesort').reset_index(drop=True)
+    keys = [data['SubmitDateTime'].dt.normalize()]
+    if 'UserId' in data:
+        keys.insert(0, data['UserId'])
+    seconds = data.groupby(keys, sort=False)['SubmitDateTime'].diff().dt.total_seconds()
+    data['ResponseTime'] = seconds.astype(object).where(seconds.notna(), None)
+    enriched_json = data.to_dict(orient='records')
     return enriched_json
 
-def calculate_scores(data):
-    """Calculates the ability scores
+def day_gaps(dates):
+    """Days between the date of every answer and the previous answer date
+
+    Parameters
+    ----------
+    dates : array-like,
+        The SubmitDateTime of every answer, in any order
+
+    Returns
+    -------
+    gaps : ndarray of int
+        0 for the answers on the first date, otherwise the number of days
+        since the closest earlier date with answers
     """
+    days = np.asarray(to_datetime64(dates), dtype='datetime64[D]')
+    unique_days = np.unique(days)
+    gaps = np.concatenate(([0], np.diff(unique_days).astype(np.int64)))
+    return gaps[np.searchsorted(unique_days, days)]
 
-    def getU(D,U):
-        U = U - (1/40) + ((1/30) * D)
-        if U <= 0:
-            return 0
-        return U
-
-    def computeHSHSscore(x_ij, d_i, t_ij):
-        """
-        Equation (6) in Klinkerberg's paper
-        High Speed High Stakes
-
-        x_ij : bool, answer correct or incorrect to item ij
-        t_ij : float, response time for item ij
-        d_i : float, time limit
-        a_i : float, disctimination parameter = 1 / d_i
-        """
-        if t_ij == None:
-            return None
-
-        a_i = 1 / d_i
-    #    try:
-    #        t = (datetime.datetime.strptime(t_ij, '%H:%M:%S.%f'))#.timestamp()
-    #    except:
-    #        t = (datetime.datetime.strptime(t_ij, '%H:%M:%S'))#.timestamp()
-    #    t = datetime.timedelta(hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond)
-    #    t_ij = t.total_seconds()
-
-        S_ij = (2 * x_ij - 1) * (a_i * d_i - a_i * t_ij)
-        return S_ij
-
-    def computeDevFromExp(K, U):
-        """
-        Equation (4) in Klinkerberg's paper
-        K measures the ability score changes over the exercises
-        """
-        if U == 0:
-            # K has default value when there is no uncertainty
-            return 0.0075
-        K_p = 4
-        K_m = .5
-
-        return K * (1 + K_p * U - K_m * U)
-
-
-    def computeERS(theta_j, beta_i, K, S_ij, Es_ij):
-        """
-        Equation (3) in Klinkerberg's paper
-        theta = ability estimate for user
-        beta = difficulty estimate for item
-        """
-        if S_ij == None:
-            return theta_j, beta_i
-        theta = theta_j + K * (S_ij - Es_ij)
-        beta = beta_i + K * (Es_ij - S_ij)
-        return theta, beta
-
-    def getExpectedScore(d_i, theta_j, beta_i):
-        """
-        Equation (7) in Klinkerberg's paper
-        """
-        a_i = 1 / d_i
-
-        div1 = (math.exp(2 * a_i * d_i * (theta_j - beta_i)) + 1)
-        div2 = math.exp(2 * a_i * d_i * (theta_j - beta_i))
-        #print(div1, div2)
-        #print(theta_j, beta_i)
-        Es_ij = a_i * d_i * (div1/ div2 - 1)- (1 / (theta_j - beta_i))
-        return Es_ij
-
-    def get_exercise_answer(data):
-        # TODO develop this method Right now not in use
-        return data["Correct"]
 
-    data = pd.DataFrame(data)
-    data['SubmitDateTime'] = pd.to_datetime(data['SubmitDateTime'])
-    unique_dates = sorted(list({item.date() for item in data['SubmitDateTime']}))
-    D = [0] + [(unique_dates[u+1] - unique_dates[u]).days for u in range(0, len(unique_dates) - 1)]
-    data['D'] = [D[unique_dates.index(date_time_obj.date())] for date_time_obj in  data["SubmitDateTime"]]
-    d_i = [500] * len(data)
-    U = 1
-    Us = []
-    K = 0.01
-    Es_ij = 0
-    theta_j = 0.00001
-    beta_i = 1
-    Ks = []
-    SSSS = []
-    for i, row in data.iterrows():
+def expected_score(d_i, theta_j, beta_i):
+    """Equation (7) in Klinkerberg's paper, for arrays
+
+    a * d * ((exp(2adx) + 1) / exp(2adx) - 1) - 1 / x with x = theta - beta
+    is written as a * d * exp(-2adx) - 1 / x, which does not overflow for
+    large abilities.
+    """
+    d_i = np.asarray(d_i, dtype=float)
+    a_i = 1 / d_i
+    x = np.asarray(theta_j, dtype=float) - np.asarray(beta_i, dtype=float)
+    return a_i * d_i * np.exp(-2 * a_i * d_i * x) - 1 / x
+
+
+def ability_scores(gaps, correct, response_times, d_i=500, U=1, K=0.01,
+                   theta_j=0.00001, beta_i=1):
+    """The scoring kernel of calculate_scores, on arrays
 
-        U = getU(row['D'], U)
+    Parameters
+    ----------
+    gaps : array-like,
+        Days since the previous answer date, see day_gaps
 
-        #print("U:",U, "D:", row['D'], "K:", K)
+    correct : array-like,
+        1 for a correct answer, 0 otherwise
 
-        S_j = computeHSHSscore(row['Correct'], d_i[i], row['ResponseTime'])
+    response_times : array-like,
+        Response times in seconds, NaN where unknown
 
-        Us.append(U)
+    d_i : float or array-like, optional (default=500)
+        Time limit
 
-        K = computeDevFromExp(K, U)
-        Ks.append(K)
+    U, K : float, optional (default=1, 0.01)
+        Initial uncertainty and K
+
+    theta_j, beta_i : float or array-like, optional (default=0.00001, 1)
+        Ability and difficulty estimates
+
+    Returns
+    -------
+    Us, Ks, S, Es : ndarray
+        Uncertainty, K, the High Speed High Stakes score (Equation 6) and
+        the expected score (Equation 7) for every answer
+    """
+    gaps = np.asarray(gaps, dtype=float)
+    n = len(gaps)
+    Us = np.empty(n)
+    Ks = np.empty(n)
+    # Equations (4) and the uncertainty depend on the previous answer
+    for i, D in enumerate(gaps.tolist()):
+        U = U - (1/40) + ((1/30) * D)
+        if U <= 0:
+            U = 0
+        K = 0.0075 if U == 0 else K * (1 + 4 * U - .5 * U)
+        Us[i] = U
+        Ks[i] = K
 
-        #theta_j, beta_i = computeERS(theta_j, beta_i, K, S_j, Es_ij)
+    d_i = np.broadcast_to(np.asarray(d_i, dtype=float), (n,))
+    a_i = 1 / d_i
+    x_ij = np.asarray(correct, dtype=float)
+    t_ij = np.asarray(response_times, dtype=float)
+    S = (2 * x_ij - 1) * (a_i * d_i - a_i * t_ij)
+    Es = np.broadcast_to(expected_score(d_i, theta_j, beta_i), (n,)).copy()
+    return Us, Ks, S, Es
 
-        Es_ij = getExpectedScore(d_i[i], theta_j, beta_i)
 
-        SSSS.append(Es_ij)
-    data['AbilityScore'] = SSSS
+def calculate_scores(data):
+    """Calculates the ability scores
+    """
+    data = pd.DataFrame(data)
+    data['SubmitDateTime'] = to_datetime64(data['SubmitDateTime'])
+    data['D'] = day_gaps(data['SubmitDateTime'])
+    _, _, _, Es = ability_scores(data['D'].values, data['Correct'].values,
+                                 pd.to_numeric(data['ResponseTime']).values)
+    data['AbilityScore'] = Es
     data_json = data.to_dict(orient='records')
     return data_json
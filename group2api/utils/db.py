@@ -0,0 +1,20 @@
+import os
+
+from pymongo import MongoClient
+
+
+def get_database():
+    """Connect to the MongoDB database configured in the environment
+
+    Reads MONGO_HOST, MONGO_PORT and MONGO_DBNAME, the same variables the
+    API uses, so batch jobs and the app always talk to the same database.
+
+    Returns
+    -------
+    db : pymongo.database.Database,
+        The configured database
+    """
+    client = MongoClient(os.environ['MONGO_HOST'], int(os.environ['MONGO_PORT']))
+    # Authentication is only needed for db in mLab servers
+    # db.authenticate(os.environ['MONGO_DBUSER'], os.environ['MONGO_DBPASS'])
+    return client[os.environ['MONGO_DBNAME']]
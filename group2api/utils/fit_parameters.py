@@ -0,0 +1,180 @@
+"""Fits the BKT parameters of every (UserId, LearningObjectiveId) pair
+
+This is an offline job, meant to run overnight on the server with the same
+environment variables as the API::
+
+    python -m group2api.utils.fit_parameters --processes 8 \\
+        --csv ../data/parameters.csv
+
+Answer sequences are read from ``submissions`` in one aggregation, the fits
+are spread over a process pool and the results are upserted into the
+``parameters`` collection batch by batch. Pairs that are already in
+``parameters`` are skipped, so an interrupted run resumes where it stopped
+(use ``--refit`` to start over). With ``--csv`` the collection is finally
+exported to the file read by ``DataHandler.get_coordinates_for_today``.
+"""
+import argparse
+import datetime
+from multiprocessing import Pool
+
+import numpy as np
+from pymongo import ASCENDING, UpdateOne
+
+try:
+    from . import moment as mo
+    from .db import get_database
+except ImportError:
+    import moment as mo
+    from db import get_database
+
+
+def get_fitted_keys(store):
+    """Returns the set of (UserId, LearningObjectiveId) pairs already fitted"""
+    fitted = store.find({}, {'_id': 0, 'UserId': 1, 'LearningObjectiveId': 1})
+    return {(f['UserId'], f['LearningObjectiveId']) for f in fitted}
+
+
+def iter_sequences(submissions, skip=()):
+    """Yields ((UserId, LearningObjectiveId), answers) for every pair
+
+    The answers of a pair are ordered by submission time. Pairs without
+    any Correct value have nothing to fit and are left out.
+    """
+    pipeline = [
+        {'$sort': {'SubmitDateTime': 1}},
+        {'$group': {'_id': {'UserId': '$UserId',
+                            'LearningObjectiveId': '$LearningObjectiveId'},
+                    'Correct': {'$push': '$Correct'}}},
+    ]
+    for group in submissions.aggregate(pipeline, allowDiskUse=True):
+        key = (group['_id']['UserId'], group['_id']['LearningObjectiveId'])
+        if key not in skip and group['Correct']:
+            yield key, group['Correct']
+
+
+def fit_sequence(task):
+    """Fits one answer sequence, runs inside the worker processes
+
+    A fit that raises is returned with None as parameters and the error,
+    so one bad sequence does not stop the pool.
+    """
+    key, answers, fitter, grain, iterations = task
+    try:
+        same = list(np.ones(len(answers)))
+        same[0] = 0
+        if fitter == 'em':
+            parameters = mo.ParameterExtractor().fit(answers, same, 'em')
+        else:
+            parameters = mo.ParameterExtractor().fit(answers, same, fitter,
+                                                     grain=grain,
+                                                     iterations=iterations)
+        return key, len(answers), [float(p) for p in parameters], None
+    except Exception as e:
+        return key, len(answers), None, '{}: {}'.format(type(e).__name__, e)
+
+
+def save_results(store, results):
+    """Upserts a batch of fit results into the parameters collection"""
+    now = datetime.datetime.utcnow()
+    requests = []
+    for (user_id, loid), n_answers, (l0, t, g, s), _ in results:
+        requests.append(UpdateOne(
+            {'UserId': user_id, 'LearningObjectiveId': loid},
+            {'$set': {'L0': l0, 'T': t, 'G': g, 'S': s,
+                      'NumberOfAnswers': n_answers, 'FittedAt': now}},
+            upsert=True))
+    if requests:
+        store.bulk_write(requests, ordered=False)
+
+
+def export_csv(store, fname):
+    """Writes the parameters collection to the file read by DataHandler"""
+    rows = [[p['UserId'], p['LearningObjectiveId'],
+             p['L0'], p['T'], p['G'], p['S']]
+            for p in store.find({}, {'_id': 0}).sort(
+                [('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING)])]
+    np.savetxt(fname, np.array(rows, dtype=float).reshape(-1, 6),
+               fmt=['%d', '%d', '%.10g', '%.10g', '%.10g', '%.10g'],
+               header='UserId LearningObjectiveId L0 T G S')
+
+
+def fit_all(db, processes=None, fitter='smart_ssr', grain=100, iterations=3,
+            batch_size=100, refit=False, csv=None):
+    """Fits every pair that is not in the parameters collection yet
+
+    Parameters
+    ----------
+    db : pymongo.database.Database,
+        Database holding the submissions and parameters collections
+
+    processes : int, optional (default=None)
+        Number of worker processes, defaults to the number of cores
+
+    fitter : string, optional (default='smart_ssr')
+        'smart_ssr' or 'em', see ParameterExtractor.fit
+
+    grain, iterations : int, optional (default=100, 3)
+        Passed on to ParameterExtractor.smart_ssr
+
+    batch_size : int, optional (default=100)
+        Number of fits written to the database at once. This is also the
+        most work lost when the job is interrupted.
+
+    refit : bool, optional (default=False)
+        Fit all pairs again instead of resuming
+
+    csv : string, optional (default=None)
+        If given, export the collection to this file when done
+
+    Returns
+    -------
+    fitted : int
+        The number of pairs fitted in this run. Pairs whose fit failed are
+        printed with their error and not stored, so a resumed run tries
+        them again.
+    """
+    store = db['parameters']
+    store.create_index([('UserId', ASCENDING),
+                        ('LearningObjectiveId', ASCENDING)], unique=True)
+    skip = set() if refit else get_fitted_keys(store)
+    if skip:
+        print('Resuming, {} pairs already fitted'.format(len(skip)))
+    tasks = ((key, answers, fitter, grain, iterations)
+             for key, answers in iter_sequences(db['submissions'], skip))
+    fitted = 0
+    pending = []
+    failed = []
+    with Pool(processes) as pool:
+        for result in pool.imap_unordered(fit_sequence, tasks, chunksize=4):
+            if result[3] is not None:
+                failed.append(result)
+                print('Fit of {} failed: {}'.format(result[0], result[3]))
+                continue
+            pending.append(result)
+            if len(pending) >= batch_size:
+                save_results(store, pending)
+                fitted += len(pending)
+                pending = []
+                print('{} pairs fitted'.format(fitted))
+    save_results(store, pending)
+    fitted += len(pending)
+    print('Done, {} pairs fitted, {} failed'.format(fitted, len(failed)))
+    if csv is not None:
+        export_csv(store, csv)
+    return fitted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--fitter', choices=['smart_ssr', 'em'],
+                        default='smart_ssr')
+    parser.add_argument('--grain', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--refit', action='store_true')
+    parser.add_argument('--csv', default=None)
+    args = parser.parse_args()
+    fit_all(get_database(), processes=args.processes, fitter=args.fitter,
+            grain=args.grain, iterations=args.iterations,
+            batch_size=args.batch_size, refit=args.refit, csv=args.csv)
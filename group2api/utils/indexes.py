@@ -0,0 +1,179 @@
+"""Index catalog of the API and a tool to bring the database in line with it
+
+Usage, with the same environment variables as the API::
+
+    python -m group2api.utils.indexes            # create missing indexes
+    python -m group2api.utils.indexes --dry-run  # only report
+    python -m group2api.utils.indexes --drop-extra
+
+The same report is available at ``<hostname>/admin/indexes`` (GET reports,
+POST reconciles).
+"""
+import argparse
+import json
+
+from pymongo import ASCENDING
+
+try:
+    from .db import get_database
+except ImportError:
+    from db import get_database
+
+
+# Indexes per collection, as (keys, options) pairs
+INDEX_CATALOG = {
+    'submissions': [
+        ([('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING),
+          ('Days', ASCENDING), ('SubmitDateTime', ASCENDING)], {}),
+        ([('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING),
+          ('ExerciseId', ASCENDING)], {}),
+        ([('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING),
+          ('SubmitDateTime', ASCENDING)], {}),
+        ([('UserId', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('Days', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('SubmitDateTime', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    'users': [
+        ([('UserName', ASCENDING)], {}),
+    ],
+    'coordinates': [
+        ([('UserId', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    'flag_coordinates': [
+        ([('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING),
+          ('_id', ASCENDING)], {}),
+    ],
+    'm2m_coordinates': [
+        ([('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING),
+          ('Days', ASCENDING)], {'unique': True}),
+    ],
+    'parameters': [
+        ([('UserId', ASCENDING), ('LearningObjectiveId', ASCENDING)],
+         {'unique': True}),
+    ],
+}
+
+# Query shapes of the routes and jobs: (used by, collection, equality
+# fields, range or sort field)
+ROUTE_QUERIES = [
+    # The listing routes page in _id order (the date route in SubmitDateTime
+    # and _id order), see list_response
+    ('/user/user_id=', 'submissions', ['UserId'], '_id'),
+    ('/users (paged)', 'submissions', [], 'UserId'),
+    ('/get_data/date=', 'submissions', [], 'SubmitDateTime'),
+    ('/get_data/day=', 'submissions', ['Days'], '_id'),
+    ('/scores/day=, /scores/latest', 'submissions',
+     ['Days', 'UserId', 'LearningObjectiveId'], 'SubmitDateTime'),
+    ('/exercises/', 'submissions', ['UserId', 'LearningObjectiveId'], None),
+    ('/scores/user_id=', 'submissions',
+     ['UserId', 'LearningObjectiveId', 'ExerciseId'], None),
+    # user_id=all searches the _id range above its high-water mark for
+    # documents without ResponseTime, then loads the users found
+    ('/response_time_enrichment/user_id=all', 'submissions', [], '_id'),
+    ('/response_time_enrichment/user_id=', 'submissions', ['UserId'], None),
+    ('/calculate_scores/', 'submissions', ['UserId'], None),
+    ('/add_days/', 'submissions', [], 'SubmitDateTime'),
+    ('/calculate_m2m_coordinates/', 'submissions',
+     ['UserId', 'LearningObjectiveId'], 'SubmitDateTime'),
+    ('/fast_m2m/, POST /fast_m2m', 'm2m_coordinates',
+     ['UserId', 'LearningObjectiveId', 'Days'], None),
+    ('/fast_m2m/ (miss), /fast_all/ (miss), POST /fast_m2m (miss)', 'submissions',
+     ['UserId', 'LearningObjectiveId', 'Days'], 'SubmitDateTime'),
+    ('/fast_all/', 'm2m_coordinates', ['UserId', 'LearningObjectiveId'], None),
+    ('check_auth', 'users', ['UserName', 'Password'], None),
+    ('/login_users/username=, /user_login/', 'users', ['UserName'], None),
+    ('/get_flag_position/, /save_flag_position/', 'coordinates',
+     ['UserId'], '_id'),
+    ('/get_flag_position2/, /save_flag_position2/', 'flag_coordinates',
+     ['UserId', 'LearningObjectiveId'], '_id'),
+    ('fit_parameters', 'parameters', ['UserId', 'LearningObjectiveId'], None),
+]
+
+
+def is_covered(keys, equality, range_field=None):
+    """True if an index with these keys serves the query shape
+
+    The equality fields have to make up a prefix of the index, in any
+    order, directly followed by the range or sort field if there is one.
+    An index made of only some of the equality fields (UserName for a
+    UserName and Password lookup) is good enough when there is no range.
+    """
+    fields = [k for k, _ in keys]
+    lead = fields[:len(equality)]
+    if not set(lead) <= set(equality):
+        return False
+    if len(lead) < len(equality):
+        return bool(lead) and range_field is None
+    return range_field is None or fields[len(lead):len(lead) + 1] == [range_field]
+
+
+def uncovered_queries(catalog=INDEX_CATALOG, queries=ROUTE_QUERIES):
+    """Returns the route queries that no index of the catalog serves
+
+    Every collection also has its built-in _id index.
+    """
+    return [{'used_by': used_by, 'collection': collection,
+             'equality': equality, 'range': range_field}
+            for used_by, collection, equality, range_field in queries
+            if not any(is_covered(keys, equality, range_field)
+                       for keys in [[('_id', ASCENDING)]] +
+                       [keys for keys, _ in catalog.get(collection, [])])]
+
+
+def reconcile(db, catalog=INDEX_CATALOG, dry_run=False, drop_extra=False):
+    """Compares the indexes of the database with the catalog
+
+    Parameters
+    ----------
+    db : pymongo.database.Database,
+        The database
+
+    dry_run : bool, optional (default=False)
+        Only report, change nothing
+
+    drop_extra : bool, optional (default=False)
+        Drop indexes that are not in the catalog
+
+    Returns
+    -------
+    report : dictionary
+        Per collection the indexes that were missing, present, not in
+        the catalog or with different options, and the uncovered queries
+    """
+    report = {'collections': {}, 'uncovered_queries': uncovered_queries(catalog)}
+    for collection_name, specs in sorted(catalog.items()):
+        collection = db[collection_name]
+        existing = dict((name, info) for name, info in
+                        collection.index_information().items() if name != '_id_')
+        result = {'missing': [], 'present': [], 'different': [], 'extra': []}
+        matched = set()
+        for keys, options in specs:
+            keys = [(k, d) for k, d in keys]
+            found = [name for name, info in existing.items()
+                     if [(k, d) for k, d in info['key']] == keys]
+            if not found:
+                result['missing'].append(keys)
+                if not dry_run:
+                    collection.create_index(keys, **options)
+                continue
+            name = found[0]
+            matched.add(name)
+            if any(existing[name].get(o, False) != v for o, v in options.items()):
+                result['different'].append(name)
+            else:
+                result['present'].append(name)
+        for name in sorted(set(existing) - matched):
+            result['extra'].append(name)
+            if drop_extra and not dry_run:
+                collection.drop_index(name)
+        report['collections'][collection_name] = result
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--drop-extra', action='store_true')
+    args = parser.parse_args()
+    print(json.dumps(reconcile(get_database(), dry_run=args.dry_run,
+                               drop_extra=args.drop_extra), indent=2))
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+
+def no_progress(done, total=None):
+    """Progress callback for work that runs outside of a job"""
+
+
+class Job():
+    """State of one piece of work handed to a JobRunner
+
+    state goes from 'queued' to 'running' to 'done' or 'failed'. The work
+    reports its progress through update, which any thread may call.
+    """
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = 'queued'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created_at = datetime.datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self._started = None
+        self._seconds = None
+
+    def update(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def to_dict(self):
+        """The job as sent by the /jobs route"""
+        if self._seconds is not None:
+            seconds = self._seconds
+        elif self._started is not None:
+            seconds = time.monotonic() - self._started
+        else:
+            seconds = None
+        return {'id': self.id,
+                'name': self.name,
+                'state': self.state,
+                'progress': {'done': self.done, 'total': self.total},
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'seconds': seconds,
+                'result': self.result,
+                'error': self.error}
+
+
+class JobRunner():
+    """Runs jobs on a bounded number of threads and remembers their state
+
+    The state lives in the process that runs the job, so with several
+    gunicorn workers a job is only known to the worker that accepted it.
+
+    Parameters
+    ----------
+    max_workers : int, optional (default=1)
+        Number of jobs that run at the same time, the others wait in the
+        queue. Keep it low so the requests are still served while a job
+        runs.
+
+    keep : int, optional (default=200)
+        Number of jobs remembered, the oldest finished jobs are forgotten
+        first
+
+    logger : logging.Logger, optional (default=None)
+        Where failing jobs are logged
+    """
+
+    def __init__(self, max_workers=1, keep=200, logger=None):
+        self.keep = keep
+        self.logger = logger or logging.getLogger(__name__)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, name, func, *args, **kwargs):
+        """Queues func(*args, progress=job.update, **kwargs) as a new job
+
+        Returns
+        -------
+        job : Job
+            The queued job, its result is the return value of func
+        """
+        job = Job(name)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget()
+        job.future = self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """Returns the job with this id, None if it is not known"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        """Returns the remembered jobs, oldest first"""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job, func, args, kwargs):
+        job.state = 'running'
+        job.started_at = datetime.datetime.utcnow()
+        job._started = time.monotonic()
+        try:
+            job.result = func(*args, progress=job.update, **kwargs)
+        except Exception as e:
+            self.logger.exception("Job {} ({}) failed".format(job.name, job.id))
+            job.error = str(e)
+            job.state = 'failed'
+        else:
+            job.state = 'done'
+        job._seconds = time.monotonic() - job._started
+        job.finished_at = datetime.datetime.utcnow()
+        return job.result
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.state in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self._jobs) - self.keep)]:
+            del self._jobs[job_id]
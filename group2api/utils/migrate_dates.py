@@ -0,0 +1,75 @@
+"""Converts SubmitDateTime strings in submissions to BSON dates
+
+Run once on an existing database, with the same environment variables as
+the API::
+
+    python -m group2api.utils.migrate_dates --batch-size 5000
+
+Documents are converted in _id order, one bulk write per batch, so the
+migration can be stopped and started again at any time. Values that are
+not valid submission times are left as they are and counted.
+"""
+import argparse
+
+from pymongo import ASCENDING, UpdateOne
+
+try:
+    from .db import get_database
+    from .snapshot import bump_version
+    from .validation import parse_submit_datetime
+except ImportError:
+    from db import get_database
+    from snapshot import bump_version
+    from validation import parse_submit_datetime
+
+
+def migrate_dates(submissions, batch_size=5000):
+    """Converts every string SubmitDateTime to a datetime
+
+    Parameters
+    ----------
+    submissions : pymongo.collection.Collection,
+        The submissions collection
+
+    batch_size : int, optional (default=5000)
+        Number of documents read and written per round trip
+
+    Returns
+    -------
+    result : dictionary
+        The number of converted and of invalid documents
+    """
+    converted = invalid = 0
+    last_id = None
+    while True:
+        query = {'SubmitDateTime': {'$type': 'string'}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(submissions.find(query, {'SubmitDateTime': 1})
+                     .sort('_id', ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+        writes = []
+        for doc in batch:
+            try:
+                date_time = parse_submit_datetime(doc['SubmitDateTime'])
+            except ValueError:
+                invalid += 1
+                continue
+            writes.append(UpdateOne({'_id': doc['_id']},
+                                    {'$set': {'SubmitDateTime': date_time}}))
+        if writes:
+            submissions.bulk_write(writes, ordered=False)
+            converted += len(writes)
+        print('{} converted, {} invalid'.format(converted, invalid))
+    return {'converted': converted, 'invalid': invalid}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+    db = get_database()
+    migrate_dates(db['submissions'], batch_size=args.batch_size)
+    bump_version(db['meta'])
@@ -1,7 +1,6 @@
 from openpyxl import load_workbook
 import numpy as np
 import datetime
-from copy import deepcopy
 import pandas as pd
 
 import os
@@ -10,8 +9,25 @@ import json
 
 sys.path.append('..')
 
+try:
+    from .bkt import (BKTParameters, DEFAULT_PARAMETERS, batch_get_p_j,
+                      get_p_j, pad_sequences)
+    from .validation import format_submit_datetime, to_datetime64
+except ImportError:
+    from bkt import (BKTParameters, DEFAULT_PARAMETERS, batch_get_p_j,
+                     get_p_j, pad_sequences)
+    from validation import format_submit_datetime, to_datetime64
 
 
+PARAMETERS_FILE = "../../data/parameters.csv"
+
+# Average (L0, T, G, S) per day, used by the fast coordinates
+AVG_LTGS = [[0.027, 0.059, 0.25, 0.1],
+            [0.027, 0.059, 0.250, 0.1],
+            [0.001, 0.149, 0.1],
+            [0.5, 0.1, 0.299, 0.1],
+            ]
+
 
 # helper function
 def get_date_from_str(yyyymmdd):
@@ -32,6 +48,259 @@ def get_date_from_str(yyyymmdd):
     #print("{}:{}:{}".format(year, month, day))
     return datetime.datetime(year, month, day, 0, 0, 0, 0)
 
+def load_parameters(user_id, loid, fname=PARAMETERS_FILE):
+    """Look up the fitted BKT parameters of a user on a learning objective
+
+    The file is the one written by utils/fit_parameters.py, with one
+    whitespace separated row per (UserId, LearningObjectiveId, L0, T, G, S).
+
+    Parameters
+    ----------
+    user_id : integer,
+        Id of the user
+
+    loid : integer,
+        Id of the learning objective
+
+    fname : string, optional (default=PARAMETERS_FILE)
+        Path of the parameters file
+
+    Returns
+    -------
+    parameters : list of floats or None,
+        [L0, T, G, S] or None if the pair has not been fitted
+
+    Raises
+    ------
+    FileNotFoundError
+        If the parameters file does not exist
+    """
+    with open(fname) as f:
+        table = np.atleast_2d(np.genfromtxt(f))
+    if table.size == 0:
+        return None
+    rows = table[(table[:, 0] == int(user_id)) & (table[:, 1] == int(loid))]
+    if len(rows) == 0:
+        return None
+    return list(rows[-1, 2:6])
+
+
+def _round_2(values):
+    """round(value, 2) of every value, as the scalar loop rounds them
+
+    np.round scales by 100 first, which can land on the other side of a
+    tie than the rounding of the exact value. Values that close to a tie
+    are rounded one by one.
+    """
+    rounded = np.round(values, 2)
+    scaled = np.abs(values * 100)
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 1e-8 * np.maximum(scaled, 1)
+    for index in zip(*np.nonzero(near_tie)):
+        rounded[index] = round(values[index], 2)
+    return rounded
+
+
+def batch_from_p_j_to_coord(p_j_list):
+    """from_p_j_to_coord for several p_j vectors in one batched pass
+
+    The zig-zag walk goes over time once, for all vectors together.
+
+    Parameters
+    ----------
+    p_j_list : list of array-like,
+        Outputs of get_p_j or batch_get_p_j
+
+    Returns
+    -------
+    coords : list of lists,
+        The coordinates of every vector, normalised to a maximum of 1
+    """
+    summed, lengths = pad_sequences([np.cumsum(p_j)[::-1] for p_j in p_j_list])
+    n_vectors, width = summed.shape
+    current = np.zeros(n_vectors)
+    direction = np.ones(n_vectors)
+    walked = np.empty((n_vectors, width))
+    for t in range(width):
+        speed = summed[:, t]
+        current += direction * speed
+        bounce = np.abs(current) > speed
+        if bounce.any():
+            speed = speed[bounce]
+            direction[bounce] *= -1
+            current[bounce] = (np.minimum(speed, np.maximum(-speed, current[bounce])) +
+                               direction[bounce] * speed)
+        walked[:, t] = current
+    walked = _round_2(walked)
+
+    coords = []
+    for row, length in zip(walked, lengths):
+        row = row[:length]
+        if length == 0:
+            coords.append([0.0])
+            continue
+        max_val = row.max()
+        if max_val > 0:
+            row = row / max_val
+        coords.append(row.tolist())
+    return coords
+
+
+def from_p_j_to_coord(p_j):
+    """Turn moment-by-moment probabilities into zig-zag graph coordinates
+
+    Walks down the reversed cumulative sum of p_j, bouncing between plus
+    and minus the current value, see batch_from_p_j_to_coord.
+
+    Parameters
+    ----------
+    p_j : array-like,
+        Output of get_p_j or batch_get_p_j
+
+    Returns
+    -------
+    coords : list,
+        Coordinates normalised to a maximum of 1
+    """
+    return batch_from_p_j_to_coord([p_j])[0]
+
+
+def coordinates_from_answers(answers, parameters):
+    """Moment-by-moment coordinates of one answer sequence
+
+    Needs nothing but the answers and the parameters, so callers only have
+    to fetch the submissions they are interested in.
+
+    Parameters
+    ----------
+    answers : list,
+        The Correct values in submission order
+
+    parameters : list,
+        (L0, T, G, S)
+
+    Returns
+    -------
+    coords : list,
+        See from_p_j_to_coord
+    """
+    p_j = batch_get_p_j([answers], parameters)[1][0]
+    return from_p_j_to_coord(p_j)
+
+
+def fast_coordinates(answers, day):
+    """Coordinates of answers using the average parameters of a day index"""
+    return coordinates_from_answers(answers, AVG_LTGS[day])
+
+
+def batch_fast_coordinates(answer_sequences, days):
+    """fast_coordinates for several answer sequences in one batched pass
+
+    Parameters
+    ----------
+    answer_sequences : list of lists,
+        The Correct values of every sequence in submission order
+
+    days : list of int,
+        The day index of every sequence, selects its row of AVG_LTGS
+
+    Returns
+    -------
+    coords : list of lists,
+        The coordinates of every sequence
+    """
+    parameters = [AVG_LTGS[day] for day in days]
+    p_j = batch_get_p_j(answer_sequences, parameters)[1]
+    return batch_from_p_j_to_coord(p_j)
+
+
+def coordinates_for_user(answers, user_id, loid, fitter='smart_ssr'):
+    """Coordinates of answers using the fitted parameters of the user
+
+    The parameters come from PARAMETERS_FILE, or are fitted on the answers
+    with the given fitter if the user is not in there.
+    """
+    same = list(np.ones(len(answers)))
+    try:
+        same[0] = 0
+    except IndexError:
+        return []
+    try:
+        parameters = load_parameters(user_id, loid)
+    except FileNotFoundError:
+        parameters = None
+    if parameters is None:
+        parameters = ParameterExtractor().fit(answers, same, fitter)
+    return coordinates_from_answers(answers, parameters)
+
+
+# Attempt selections of MomentByMoment.filter_answers
+FILTER_METHODS = ['all', 'first', 'second', 'all but first', 'last']
+
+
+def _group_codes(keys):
+    """Number the distinct combinations of the key arrays 0, 1, 2, ..."""
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        # factorize is a hash pass and gives missing values -1
+        inverse = pd.factorize(np.asarray(key))[0].astype(np.int64) + 1
+        codes = pd.factorize(codes * (inverse.max() + 1) + inverse)[0]
+    return codes
+
+
+def attempt_ranks(exercise_ids, groups=()):
+    """Number the attempts on every exercise in order of the answers
+
+    Parameters
+    ----------
+    exercise_ids : array-like,
+        The exercise of every answer, in submission order
+
+    groups : tuple of array-like, optional (default=())
+        Extra keys such as the user ids and learning objective ids, to
+        rank the attempts of many users in one call
+
+    Returns
+    -------
+    ranks : ndarray of int,
+        0 for the first attempt of the (group, exercise), 1 for the
+        second and so on
+
+    attempts : ndarray of int,
+        The number of attempts of the (group, exercise) of every answer
+    """
+    if len(exercise_ids) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    codes = _group_codes(list(groups) + [exercise_ids])
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_codes)) + 1]
+    run_start = np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+    ranks = np.empty(len(codes), dtype=int)
+    ranks[order] = np.arange(len(codes)) - run_start
+    return ranks, np.bincount(codes)[codes]
+
+
+def attempt_mask(method, exercise_ids, groups=()):
+    """Boolean mask of the answers kept by a filter_answers method
+
+    'first' and 'second' keep the first and second attempt on every
+    exercise, 'all but first' drops the first attempts and 'last' keeps
+    the last attempts. See attempt_ranks for groups.
+    """
+    if method not in FILTER_METHODS:
+        raise NotImplementedError
+    ranks, attempts = attempt_ranks(exercise_ids, groups)
+    if method == 'first':
+        return ranks == 0
+    if method == 'second':
+        return ranks == 1
+    if method == 'all but first':
+        return ranks > 0
+    if method == 'last':
+        return ranks == attempts - 1
+    return np.ones(len(ranks), dtype=bool)
+
+
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
@@ -40,28 +309,90 @@ class MyEncoder(json.JSONEncoder):
             return float(obj)
         elif isinstance(obj, np.ndarray):
             return obj.tolist()
+        elif isinstance(obj, datetime.datetime):
+            return format_submit_datetime(obj)
         else:
             return super(MyEncoder, self).default(obj)
 
 
 class DataHandler():
 
-    def __init__(self, submissions=None):
-        df = pd.DataFrame(submissions)
-        self.dates = np.array(df['SubmitDateTime'])
-        self.user_ids = np.array(df['UserId'])
-        self.exercise_ids = np.array(df['ExerciseId'])
-        self.learn_obj_ids = np.array(df['LearningObjectiveId'])
-        self.corrects = np.array(df['Correct'])
-        self.ability_scores = np.array(df['AbilityAfterAnswer'])
+    def __init__(self, submissions=None, snapshot=None):
+        """Either give the submission documents or a SubmissionSnapshot.
+
+        With a snapshot the columns are taken from it as they are, nothing
+        is read from the database except the documents added since its
+        last refresh.
+        """
+        if snapshot is not None:
+            columns = snapshot.refresh()
+        else:
+            df = pd.DataFrame(submissions)
+            columns = dict((field, np.array(df[field])) for field in
+                           ['SubmitDateTime', 'UserId', 'ExerciseId',
+                            'LearningObjectiveId', 'Correct',
+                            'AbilityAfterAnswer'])
+            # release memory
+            del df
+        self.dates = np.array(to_datetime64(columns['SubmitDateTime']),
+                              dtype='datetime64[ns]')
+        self.days = self.dates.astype('datetime64[D]')
+        self.user_ids = columns['UserId']
+        self.exercise_ids = columns['ExerciseId']
+        self.learn_obj_ids = columns['LearningObjectiveId']
+        self.corrects = columns['Correct']
+        self.ability_scores = columns['AbilityAfterAnswer']
         self.m2m = MomentByMoment(self.user_ids, self.corrects, self)
-        # release memory
-        self.avg_ltgs = [[0.027, 0.059, 0.25, 0.1],
-                        [0.027, 0.059, 0.250, 0.1],
-                        [0.001, 0.149, 0.1],
-                        [0.5, 0.1, 0.299, 0.1],
-                        ]
-        del df
+        self.avg_ltgs = AVG_LTGS
+        self._day_index = None
+        self._pair_index = None
+
+    def _build_index(self):
+        """Group the rows per (user, objective, day) and per (user, objective)"""
+        days = self.days.astype(np.int64)
+        codes = _group_codes([self.user_ids, self.learn_obj_ids, days])
+        order = np.argsort(codes, kind='mergesort')
+        groups = np.split(order, np.flatnonzero(np.diff(codes[order])) + 1)
+        day_index = {}
+        pairs = {}
+        for rows in groups:
+            if len(rows) == 0:
+                continue
+            key = (self.user_ids[rows[0]], self.learn_obj_ids[rows[0]])
+            day_index[key + (days[rows[0]],)] = rows
+            pairs.setdefault(key, []).append(rows)
+        self._pair_index = dict((key, np.sort(np.concatenate(rows)))
+                                for key, rows in pairs.items())
+        self._day_index = day_index
+
+    def get_rows(self, user_id, loid, date_id=None):
+        """Row numbers of a user on a learning objective, in data order
+
+        The index is built on the first call, after that a lookup only
+        costs time for the rows of the user.
+
+        Parameters
+        ----------
+        user_id, loid : integer,
+            Ids of the user and of the learning objective
+
+        date_id : datetime, optional (default=None)
+            Only the rows of this date
+
+        Returns
+        -------
+        rows : ndarray of int
+        """
+        if self._day_index is None:
+            self._build_index()
+        if date_id is None:
+            rows = self._pair_index.get((user_id, loid))
+        else:
+            day = np.datetime64(date_id, 'D').astype(np.int64)
+            rows = self._day_index.get((user_id, loid, day))
+        if rows is None:
+            return np.zeros(0, dtype=int)
+        return rows
 
     def get_max_row(self, column=1):
         val = self.ws.cell(row=1, column=column).value
@@ -100,12 +431,11 @@ class DataHandler():
         return self.m2m.get_p_T(user_id, method, oid)
 
     def get_graph_variables(self, user_id=0, method='all', oid=None):
-        p_j = self.m2m.get_p_j(user_id=user_id, method=method,
-                               objective_id=oid)
+        answers, rows, excs = self.m2m.filter_answers(user_id, method, oid)
+        p_j = self.m2m.get_p_j(user_id, answers=answers)
         self.graph_length = len(p_j)
-        self.boundary_list, self.color_list = self.m2m.get_color_bars()
-        return self.m2m.get_p_j(user_id=user_id, method=method,
-                                objective_id=oid)
+        self.boundary_list, self.color_list = self.m2m.get_color_bars(excs, rows)
+        return p_j
 
     def get_color_ids(self, fname='res/ID exercises.xlsx'):
         wb = load_workbook(fname)
@@ -124,127 +454,75 @@ class DataHandler():
         return (pre, cin, cex, aex, raex, post)
 
     def get_coordinates_for_today(self, user_id=0, loid=0,
-                                  date_id=None):
+                                  date_id=None, fitter='smart_ssr'):
         # todo: change from answers to coordinates
-        if date_id is None:
-            answers = self.corrects[np.where((self.user_ids == user_id)&
-                                             (self.learn_obj_ids == loid))]
-        else:
-            datelist = []
-            for sdt in self.dates:
-                try:
-                    datelist.append(datetime.datetime.strptime(sdt, "%Y-%m-%d %H:%M:%S.%f").replace(hour=0, minute=0, second=0, microsecond=0))
-                except ValueError:
-                    datelist.append(datetime.datetime.strptime(sdt, "%Y-%m-%d %H:%M:%S").replace(hour=0, minute=0, second=0, microsecond=0))
-                except TypeError:
-                    datelist.append(None)
-            datelist = np.array(datelist)
-            answers = self.corrects[np.where((self.user_ids == user_id) &
-                                             (datelist == date_id) &
-                                             # date_id is 2017-11-28 but self dates= 2017-11-28 09:49:11.913
-                                             (self.learn_obj_ids == loid))]
-            #if (datelist == date_id):
-            #   print("entered id")
-            print("date_id",type(date_id), type(datelist[0]), date_id==datelist[0])
-        same = list(np.ones(len(answers)))
-        try:
-            same[0] = 0
-        except IndexError:
-            return []
-        try:
-            with open("../../data/parameters.csv") as f:
-                parameters = np.genfromtxt(f)
-                users = parameters[:1]
-                parameters = parameters[np.where(str(user_id) == users)]
-                parameters = parameters[1:]
-        except FileNotFoundError:
-            parameters = ParameterExtractor().smart_ssr(answers, same, 100, 3)
-        user_m2m = deepcopy(self.m2m)
-        user_m2m.set_initial_probabilities(*parameters)
-        p_j = user_m2m.get_p_j(user_id, answers=answers)
-        coordinates = self.from_p_j_to_coord(p_j)
-        return coordinates
+        answers = self.corrects[self.get_rows(user_id, loid, date_id)]
+        return coordinates_for_user(answers, user_id, loid, fitter)
 
     def from_p_j_to_coord(self, p_j):
-        summed_array = np.cumsum(p_j)[::-1]
-        #print(summed_array)
-        direction = 1
-        coords = []
-        current = 0
-        for speed in summed_array:
-            current += direction * speed
-            if abs(current) > speed:
-                current = min(speed, max(-1 * speed, current))
-                direction *= -1
-                current += direction * speed
-            coords.append(round(current, 2))
-        try:
-            max_val = coords[np.argmax(coords)]
-        except Exception as e:
-            return [0.0]
-        if max_val > 0:
-            coords = [i/max_val for i in coords]
-        return coords
+        return from_p_j_to_coord(p_j)
 
     def fast_coords_for_today(self, user_id, corrects, day):
-        parameters = self.avg_ltgs[day]
-        user_m2m = deepcopy(self.m2m)
-        user_m2m.set_initial_probabilities(*parameters)
-        p_j = user_m2m.get_p_j(user_id, answers=corrects)
-        coordinates = self.from_p_j_to_coord(p_j)
-        return coordinates
+        return fast_coordinates(corrects, day)
 
 
 class MomentByMoment():
+    """Moment-by-moment learning of the users of a DataHandler
 
-    def __init__(self, user_ids, corrects, handler: DataHandler):
-        self.p_l0 = 0.064
-        self.p_T = 0.095
-        self.p_G = 0.299
-        self.p_S = 0.1
-        self.p_ln = []
+    Only holds references to the data of the handler and an immutable
+    BKTParameters record. Nothing is stored per call, so one instance can
+    be shared between threads; with_parameters gives an instance with
+    other probabilities without copying any data.
+    """
+
+    def __init__(self, user_ids, corrects, handler: DataHandler,
+                 parameters=DEFAULT_PARAMETERS):
+        self.parameters = BKTParameters(*parameters)
         self.user_ids = user_ids
-        self.users = np.unique(user_ids)
         self.answers = corrects
         self.handler = handler
-        self.list_p_T = []
 
-    def set_initial_probabilities(self, l0, T, G, S):
-        self.p_l0 = l0
-        self.p_T = T
-        self.p_G = G
-        self.p_S = S
+    def with_parameters(self, l0, T, G, S):
+        return MomentByMoment(self.user_ids, self.answers, self.handler,
+                              BKTParameters(l0, T, G, S))
 
     def get_p_T(self, user_id, method='all', objective_id=None):
-        return self.list_p_T[:]
+        user_answers = self.filter_answers(user_id, method, objective_id)[0]
+        return get_p_j(user_answers, self.parameters)[0][:-2]
 
     def get_p_j(self, user_id, method='all', objective_id=None, answers=None):
-        user_answers = self.filter_answers(user_id, method, objective_id)
-        if answers is not None:
-            user_answers = answers
-        p_ln = self.calculate_ln(user_answers)
-        p_not_ln_t = [(1 - ln) * self.p_T for ln in p_ln]
-        p_not_ln_not_t = [(1 - ln) * (1 - self.p_T) for ln in p_ln]
-        self.list_p_T = p_ln[:-2]
-        return self.calculate_p_j(user_answers, p_ln, p_not_ln_t,
-                                  p_not_ln_not_t)
+        if answers is None:
+            answers = self.filter_answers(user_id, method, objective_id)[0]
+        return get_p_j(answers, self.parameters)[1]
+
+    def get_p_j_batch(self, answer_sequences):
+        """Return p_j for several answer sequences in one vectorized pass
+
+        Uses the parameters of this instance for every sequence, so the
+        result equals calling get_p_j with answers=... for each of them.
+        """
+        return batch_get_p_j(answer_sequences, self.parameters)[1]
 
     def filter_answers(self, user_id, method, objectives_id):
-        user_answers = self.answers[:]
-        user_objectives = self.handler.learn_obj_ids[:]
-        user_ids = self.user_ids[:]
-        user_excs = self.handler.exercise_ids[:]
-        user_dates = self.handler.dates[:]
-        self.chosen_ids = np.where(
-            (self.handler.learn_obj_ids == objectives_id) &
-            (self.user_ids == user_id))
-
-        user_answers = user_answers[self.chosen_ids]
-        user_objectives = user_objectives[self.chosen_ids]
-        user_excs = user_excs[self.chosen_ids]
-        user_ids = user_ids[self.chosen_ids]
-        if method not in ['all', 'first', 'second', 'all but first', 'last']:
+        """Select the answers of a user on a learning objective
+
+        Returns
+        -------
+        answers : list,
+            The answers kept by method, see attempt_mask
+
+        rows : ndarray,
+            Rows of the handler with all answers of the user on the
+            objective
+
+        exercise_ids : ndarray,
+            The exercise of every row
+        """
+        if method not in FILTER_METHODS:
             raise NotImplementedError
+        rows = self.handler.get_rows(user_id, objectives_id)
+        user_answers = self.answers[rows]
+        user_excs = self.handler.exercise_ids[rows]
         if method == 'first':
             user_answers = self.filter_all_but_first(user_answers, user_excs)
         if method == 'second':
@@ -253,98 +531,21 @@ class MomentByMoment():
             user_answers = self.filter_first(user_answers, user_excs)
         if method == 'last':
             user_answers = self.filter_all_but_last(user_answers, user_excs)
-        self.excs = user_excs
-        return user_answers
+        return user_answers, rows, user_excs
 
     def filter_all_but_first(self, answers, exercise_ids):
-        exercises_processed = []
-        return_answers = []
-        for i in range(len(answers)):
-            if exercise_ids[i] not in exercises_processed:
-                return_answers.append(answers[i])
-                exercises_processed.append(exercise_ids[i])
-        return return_answers
+        return list(np.asarray(answers)[attempt_mask('first', exercise_ids)])
 
     def filter_all_but_second(self, answers, exercise_ids):
-        exercises_processed = []
-        exercises_processed_twice = []
-        return_answers = []
-        for i in range(len(answers)):
-            if exercise_ids[i] not in exercises_processed:
-                exercises_processed.append(exercise_ids[i])
-            else:
-                if exercise_ids[i] not in exercises_processed_twice:
-                    return_answers.append(answers[i])
-                    exercises_processed_twice.append(exercise_ids[i])
-        return return_answers
+        return list(np.asarray(answers)[attempt_mask('second', exercise_ids)])
 
     def filter_first(self, answers, exercise_ids):
-        exercises_processed = []
-        return_answers = []
-        for i in range(len(answers)):
-            if exercise_ids[i] not in exercises_processed:
-                exercises_processed.append(exercise_ids[i])
-            else:
-                return_answers.append(answers[i])
-        return return_answers
+        return list(np.asarray(answers)[attempt_mask('all but first', exercise_ids)])
 
     def filter_all_but_last(self, answers, exercise_ids):
-        answers = answers[::-1]
-        exercises_processed = []
-        return_answers = []
-        for i in range(len(answers)):
-            if exercise_ids[i] not in exercises_processed:
-                return_answers.append(answers[i])
-                exercises_processed.append(exercise_ids[i])
-        return return_answers[::-1]
-
-    def calculate_ln(self, answers):
-        p_ln = []
-        for answer_id in range(len(answers)):
-            if len(p_ln) == 0:
-                k = self.p_l0
-            else:
-                k = p_ln[-1]
-            s = self.p_S
-            g = self.p_G
-            if answers[answer_id] == 1:
-                ln_prev_given_res = (k * (1 - s)) / (
-                (k * (1 - s)) + ((1 - k) * g))
-            else:
-                ln_prev_given_res = (k * s) / ((k * s) + ((1 - k) * (1 - g)))
-            p_ln.append(ln_prev_given_res + (1 - ln_prev_given_res) * self.p_T)
-        return p_ln
-
-    def calculate_p_j(self, answers, ln, n_ln_t, n_ln_n_t):
-        p_j = []
-        for a_id in range(len(answers) - 2):
-            p_l = ln[a_id]
-            p_nl_t = n_ln_t[a_id]
-            x = n_ln_n_t[a_id]
-            g = self.p_G
-            t = self.p_T
-            s = self.p_S
-            if answers[a_id + 1] == 1:
-                if answers[a_id + 2] == 1:  # RR
-                    a_ln = (1 - s) ** 2
-                    a_n_ln_n_t = g * (1 - t) * g + g * t * (1 - s)
-                else:  # RW
-                    a_ln = s * (1 - self.p_S)
-                    a_n_ln_n_t = g * (1 - t) * (1 - g) + g * t * s
-            else:
-                if answers[a_id + 2] == 1:  # WR
-                    a_ln = s * (1 - self.p_S)
-                    a_n_ln_n_t = g * (1 - t) * (1 - g) + (1 - g) * t * (1 - s)
-                else:  # WW
-                    a_ln = s ** 2
-                    a_n_ln_n_t = (1 - g) * (1 - t) * (1 - g) + (1 - g) * t * s
-            a_n_ln_t = a_ln
-            a12 = p_l * a_ln + p_nl_t * a_n_ln_t + x * a_n_ln_n_t
-            p_j.append(a_n_ln_t * p_nl_t / a12)
-        return p_j
+        return list(np.asarray(answers)[attempt_mask('last', exercise_ids)])
 
-    def get_color_bars(self):
-        excs = self.excs
+    def get_color_bars(self, excs, rows):
         bounds = [0]
         colors = ['blue', 'red', 'green', 'orange', 'purple', 'magenta']
         # find pre bound
@@ -380,7 +581,7 @@ class MomentByMoment():
 
         # Find class adaptive
         bound += 1
-        dates = self.handler.dates[self.chosen_ids]
+        dates = self.handler.dates[rows]
         d = dates[bound]
         while dates[bound + 1] == d:
             bound += 1
@@ -412,9 +613,12 @@ class ParameterExtractor():
         # params = [L0, T, G, S]
         self.params_min = [1e-15 for i in range(4)]
         self.params_max = [1.0, 1.0, 0.3, 0.1]
+        # Most grid points brute_force_params evaluates at once
+        self.grid_chunk = 2 ** 20
 
     def brute_force_params(self, answers, same, grain=100, L0_fix=None,
-                           T_fix=None, G_fix=None, S_fix=None, ):
+                           T_fix=None, G_fix=None, S_fix=None,
+                           vectorized=True):
         # set ranges up
         best_l0 = L0_fix
         best_t = T_fix
@@ -425,6 +629,29 @@ class ParameterExtractor():
         T_range = self.get_range(T_fix, 1, grain)
         G_range = self.get_range(G_fix, 2, grain)
         S_range = self.get_range(S_fix, 3, grain)
+        if vectorized:
+            ranges = [L0_range, T_range, G_range, S_range]
+            grid = [np.asarray(r, dtype=float).reshape(
+                [-1 if i == j else 1 for j in range(4)])
+                for i, r in enumerate(ranges)]
+            # Walk the grid in chunks of L0 values so a full 4-D grid does
+            # not have to fit in memory. Chunks come in grid order and only
+            # a strictly lower SSR replaces the best, so ties still go to
+            # the first minimum like in the loops below.
+            per_l0 = len(T_range) * len(G_range) * len(S_range)
+            step = max(1, self.grid_chunk // max(1, per_l0))
+            for start in range(0, len(L0_range), step):
+                SSR = self.get_s_s_r_grid(grid[0][start:start + step], *grid[1:],
+                                          answers=answers, sames=same)
+                SSR = np.where(np.isnan(SSR), np.inf, SSR)
+                if SSR.size == 0:
+                    break
+                best = np.unravel_index(np.argmin(SSR), SSR.shape)
+                if SSR[best] < best_SSR:
+                    best_SSR = SSR[best]
+                    best_l0, best_t, best_g, best_s = [
+                        r[i] for r, i in zip(ranges, (start + best[0],) + best[1:])]
+            return best_l0, best_t, best_g, best_s
         for L0 in L0_range:
             # print('------------------------------------\nL0 is now at:{}'.format(L0))
             for T in T_range:
@@ -461,6 +688,39 @@ class ParameterExtractor():
             L = L_given_answer + (1.0 - L_given_answer) * T
         return SSR
 
+    def get_s_s_r_grid(self, L0, T, G, S, answers, sames=None):
+        """Evaluate get_s_s_r for a whole grid of parameters at once
+
+        L0, T, G and S are arrays that broadcast against each other, e.g.
+        one axis per parameter. The answer sequence is walked once and
+        every grid point is updated in the same NumPy operation.
+
+        Returns
+        -------
+        SSR : ndarray,
+            Sum of squared residuals with the broadcast shape of the inputs
+        """
+        S = np.maximum(1E-15, S)
+        T = np.maximum(1E-15, T)
+        G = np.maximum(1E-15, G)
+        L0 = np.maximum(1E-15, L0)
+        L0, T, G, S = np.broadcast_arrays(L0, T, G, S)
+        SSR = np.zeros(L0.shape)
+        L = L0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for same, answer in zip(sames, answers):
+                if same == 0:
+                    L = L0
+                SSR += (answer - (L * (1.0 - S) + (1.0 - L) * G)) ** 2
+                if answer == 0:
+                    L_given_answer = (L * S) / (
+                    (L * S) + ((1.0 - L) * (1.0 - G)))
+                else:
+                    L_given_answer = (L * (1.0 - S)) / (
+                    (L * (1.0 - S)) + ((1.0 - L) * G))
+                L = L_given_answer + (1.0 - L_given_answer) * T
+        return SSR
+
     def get_range(self, possible_range, par_id, grain):
         if possible_range is None:
             return np.linspace(self.params_min[par_id],
@@ -469,7 +729,136 @@ class ParameterExtractor():
                                endpoint=False)[1:]
         return [possible_range]
 
-    def smart_ssr(self, answers, same, grain, iterations):
+    def fit(self, answers, same, method='smart_ssr', **kwargs):
+        """Fit the four BKT parameters with the chosen fitter
+
+        Parameters
+        ----------
+        answers : list,
+            The answer sequence, 1 for correct and 0 for wrong
+
+        same : list,
+            0 where a new sequence starts (L is reset to L0), 1 elsewhere
+
+        method : string, optional (default='smart_ssr')
+            'smart_ssr' for the coordinate descent over the SSR grid or
+            'em' for expectation-maximization. Extra keyword arguments are
+            passed on to the fitter.
+
+        Returns
+        -------
+        parameters : tuple,
+            (L0, T, G, S)
+        """
+        if method == 'smart_ssr':
+            return self.smart_ssr(answers, same, kwargs.get('grain', 100),
+                                  kwargs.get('iterations', 3), verbose=False)
+        if method == 'em':
+            return self.em_fit(answers, same, **kwargs)
+        raise NotImplementedError
+
+    def clip_params(self, params):
+        return [min(max(p, lo), hi) for p, lo, hi in
+                zip(params, self.params_min, self.params_max)]
+
+    def em_fit(self, answers, same, iterations=100, tol=1e-6, initial=None):
+        """Fit the BKT parameters with expectation-maximization
+
+        Baum-Welch on the two state (unlearned, learned) hidden Markov
+        model behind get_s_s_r: L0 is the prior of being learned at the
+        start of a sequence, T the chance to learn after an answer, G and
+        S the guess and slip chances. Every iteration is one scaled
+        forward-backward pass, and the parameters are kept within
+        params_min and params_max.
+
+        Parameters
+        ----------
+        answers : list,
+            The answer sequence, 1 for correct and 0 for wrong
+
+        same : list,
+            0 where a new sequence starts (L is reset to L0), 1 elsewhere
+
+        iterations : int, optional (default=100)
+            Maximum number of EM iterations
+
+        tol : float, optional (default=1e-6)
+            Stop when no parameter changes more than this
+
+        initial : list, optional (default=None)
+            Starting (L0, T, G, S), defaults to DEFAULT_PARAMETERS
+
+        Returns
+        -------
+        parameters : tuple,
+            (L0, T, G, S)
+        """
+        if initial is None:
+            initial = list(DEFAULT_PARAMETERS)
+        l0, t, g, s = self.clip_params(initial)
+        answers = [1 if a == 1 else 0 for a in answers]
+        n = len(answers)
+        if n == 0:
+            return l0, t, g, s
+        starts = [i == 0 or same[i] == 0 for i in range(n)]
+        ends = starts[1:] + [True]
+        for _ in range(iterations):
+            emissions = [(g, 1 - s) if a else (1 - g, s) for a in answers]
+            # forward pass, alpha normalised at every step
+            alpha = []
+            scale = []
+            for i in range(n):
+                if starts[i]:
+                    p1 = l0
+                else:
+                    p1 = alpha[-1][1] + alpha[-1][0] * t
+                a0 = (1 - p1) * emissions[i][0]
+                a1 = p1 * emissions[i][1]
+                c = a0 + a1
+                alpha.append((a0 / c, a1 / c))
+                scale.append(c)
+            # backward pass with the same scaling
+            beta = [(1.0, 1.0)] * n
+            for i in range(n - 2, -1, -1):
+                if ends[i]:
+                    continue
+                e0, e1 = emissions[i + 1]
+                b0, b1 = beta[i + 1]
+                c = scale[i + 1]
+                beta[i] = (((1 - t) * e0 * b0 + t * e1 * b1) / c,
+                           e1 * b1 / c)
+            # expected counts
+            start_learned = start_count = 0.0
+            learn = learn_from = 0.0
+            unlearned = unlearned_right = 0.0
+            learned = learned_wrong = 0.0
+            for i in range(n):
+                g0 = alpha[i][0] * beta[i][0]
+                g1 = alpha[i][1] * beta[i][1]
+                g0, g1 = g0 / (g0 + g1), g1 / (g0 + g1)
+                if starts[i]:
+                    start_learned += g1
+                    start_count += 1
+                if not ends[i]:
+                    learn += (alpha[i][0] * t * emissions[i + 1][1] *
+                              beta[i + 1][1] / scale[i + 1])
+                    learn_from += g0
+                unlearned += g0
+                unlearned_right += g0 * answers[i]
+                learned += g1
+                learned_wrong += g1 * (1 - answers[i])
+            new = [start_learned / start_count,
+                   learn / learn_from if learn_from > 0 else t,
+                   unlearned_right / unlearned if unlearned > 0 else g,
+                   learned_wrong / learned if learned > 0 else s]
+            new = self.clip_params(new)
+            change = max(abs(a - b) for a, b in zip(new, [l0, t, g, s]))
+            l0, t, g, s = new
+            if change < tol:
+                break
+        return l0, t, g, s
+
+    def smart_ssr(self, answers, same, grain, iterations, verbose=True):
         best_l0 = \
         self.brute_force_params(answers, same, grain, None, 0.0, 0.0, 0.0)[0]
         best_t = \
@@ -494,5 +883,6 @@ class ParameterExtractor():
             best_s = \
             self.brute_force_params(answers, same, grain, best_l0, best_t,
                                     best_g, None)[3]
-            print(best_l0, best_t, best_g, best_s)
+            if verbose:
+                print(best_l0, best_t, best_g, best_s)
         return best_l0, best_t, best_g, best_s
@@ -0,0 +1,146 @@
+"""Recomputes the response times and ability scores of every user
+
+This is the offline counterpart of ``/response_time_enrichment/user_id=all``
+and ``/calculate_scores/user_id=all``, run with the same environment
+variables as the API::
+
+    python -m group2api.utils.recompute_scores --processes 8
+
+The users are split into partitions of ``--partition-size`` users which are
+handed out to a process pool. Every worker streams the submissions of its
+users with a projection, computes the response times first and the ability
+scores from them, and writes both back with batched bulk updates. A line is
+printed per finished partition and users whose submissions miss a field are
+collected as failed ids, like the routes do.
+"""
+import argparse
+from multiprocessing import Pool
+
+from pymongo import UpdateOne
+
+try:
+    from . import calculations as calc
+    from .db import get_database
+except ImportError:
+    import calculations as calc
+    from db import get_database
+
+
+STEPS = ('response_times', 'scores')
+
+PROJECTION = {'_id': 1, 'SubmitDateTime': 1, 'ExerciseId': 1,
+              'ResponseTime': 1, 'Correct': 1}
+
+
+def partition(user_ids, size):
+    """Splits the user ids into lists of at most size ids"""
+    return [user_ids[start:start + size]
+            for start in range(0, len(user_ids), size)]
+
+
+def recompute_user(submissions, user_id, steps=STEPS):
+    """Returns the update operations for the submissions of one user
+
+    Raises KeyError when a field needed by a step is missing.
+    """
+    user_subs = list(submissions.find({'UserId': user_id}, PROJECTION))
+    if not user_subs:
+        return []
+    updates = {sub['_id']: {} for sub in user_subs}
+    if 'response_times' in steps:
+        for item in calc.get_response_time(user_subs):
+            updates[item['_id']]['ResponseTime'] = item['ResponseTime']
+        for sub in user_subs:
+            sub['ResponseTime'] = updates[sub['_id']]['ResponseTime']
+    if 'scores' in steps:
+        for item in calc.calculate_scores(user_subs):
+            updates[item['_id']]['AbilityScore'] = item['AbilityScore']
+    return [UpdateOne({'_id': _id}, {'$set': fields})
+            for _id, fields in updates.items() if fields]
+
+
+def recompute_partition(task):
+    """Recomputes one partition of users, runs inside the worker processes
+
+    Every worker opens its own connection, pymongo clients can not be
+    shared with forked processes.
+    """
+    index, user_ids, steps, batch_size = task
+    submissions = get_database()['submissions']
+    updated = 0
+    failed = []
+    pending = []
+    for user_id in user_ids:
+        try:
+            pending.extend(recompute_user(submissions, user_id, steps))
+        except KeyError:
+            failed.append(user_id)
+        if len(pending) >= batch_size:
+            submissions.bulk_write(pending, ordered=False)
+            updated += len(pending)
+            pending = []
+    if pending:
+        submissions.bulk_write(pending, ordered=False)
+        updated += len(pending)
+    return index, len(user_ids), updated, failed
+
+
+def recompute_all(db, processes=None, steps=STEPS, partition_size=200,
+                  batch_size=1000):
+    """Recomputes the response times and ability scores of all users
+
+    Parameters
+    ----------
+    db : pymongo.database.Database,
+        Database holding the submissions collection
+
+    processes : int, optional (default=None)
+        Number of worker processes, defaults to the number of cores
+
+    steps : tuple, optional (default=STEPS)
+        Which of 'response_times' and 'scores' to recompute
+
+    partition_size : int, optional (default=200)
+        Number of users per partition. Smaller partitions balance better
+        over the workers and report progress more often.
+
+    batch_size : int, optional (default=1000)
+        Number of updates per bulk_write call
+
+    Returns
+    -------
+    response : dictionary
+        The number of updated submissions and a list of failed user ids
+    """
+    user_ids = sorted(u for u in db['submissions'].distinct('UserId')
+                      if u is not None)
+    partitions = partition(user_ids, partition_size)
+    tasks = [(index, part, tuple(steps), batch_size)
+             for index, part in enumerate(partitions)]
+    updated = 0
+    failed_ids = []
+    with Pool(processes) as pool:
+        for done, (index, n_users, n_updated, failed) in enumerate(
+                pool.imap_unordered(recompute_partition, tasks), 1):
+            updated += n_updated
+            failed_ids.extend(failed)
+            print('Partition {} done ({}/{}): {} users, {} submissions updated, '
+                  '{} failed'.format(index, done, len(tasks), n_users,
+                                     n_updated, len(failed)))
+    print('Done, {} submissions updated'.format(updated))
+    return {'updated': updated, 'failed_ids': sorted(failed_ids)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--steps', nargs='+', choices=STEPS, default=STEPS)
+    parser.add_argument('--partition-size', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    response = recompute_all(get_database(), processes=args.processes,
+                             steps=args.steps,
+                             partition_size=args.partition_size,
+                             batch_size=args.batch_size)
+    if response['failed_ids']:
+        print('Failed user ids: {}'.format(response['failed_ids']))
@@ -0,0 +1,174 @@
+import threading
+
+import numpy as np
+import pandas as pd
+from pymongo import ASCENDING
+
+try:
+    from .validation import to_datetime64
+except ImportError:
+    from validation import to_datetime64
+
+
+SNAPSHOT_FIELDS = ['UserId', 'LearningObjectiveId', 'ExerciseId', 'Correct',
+                   'SubmitDateTime', 'Days', 'AbilityAfterAnswer']
+
+
+def to_columns(submissions, fields=SNAPSHOT_FIELDS):
+    """Turn a list of submission documents into a dict of NumPy columns
+
+    SubmitDateTime becomes datetime64, missing fields become None (or NaN
+    for numeric columns).
+    """
+    df = pd.DataFrame(list(submissions), columns=['_id'] + fields)
+    columns = {field: np.array(df[field]) for field in ['_id'] + fields}
+    columns['SubmitDateTime'] = np.array(to_datetime64(df['SubmitDateTime']),
+                                         dtype='datetime64[ns]')
+    return columns
+
+
+def bump_version(meta):
+    """Make every SubmissionSnapshot using meta reload on its next refresh"""
+    meta.update_one({'_id': 'submissions'}, {'$inc': {'version': 1}},
+                    upsert=True)
+
+
+class SubmissionSnapshot():
+    """In memory, columnar copy of the submissions collection
+
+    The snapshot is loaded once and after that every refresh only fetches
+    the documents with an _id above the last one seen. Changes to existing
+    documents (add_days, removals) are not picked up that way, so the code
+    making them calls invalidate, which bumps a version counter in the
+    meta collection. Every worker process compares that counter on refresh
+    and reloads when it changed.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection,
+        The submissions collection
+
+    meta : pymongo.collection.Collection, optional (default=None)
+        Collection holding the version counter. Without it the snapshot
+        only ever appends.
+    """
+
+    def __init__(self, collection, meta=None, fields=SNAPSHOT_FIELDS):
+        self.collection = collection
+        self.meta = meta
+        self.fields = fields
+        self.loaded = False
+        self.version = None
+        self.last_id = None
+        self.columns = to_columns([], fields)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.columns['_id'])
+
+    def get_version(self):
+        if self.meta is None:
+            return None
+        doc = self.meta.find_one({'_id': 'submissions'}, {'version': 1})
+        return doc['version'] if doc else 0
+
+    def invalidate(self):
+        """Force every snapshot of the collection to reload on refresh"""
+        if self.meta is not None:
+            bump_version(self.meta)
+        with self._lock:
+            self.loaded = False
+
+    def refresh(self):
+        """Load the documents added since the last refresh
+
+        Returns
+        -------
+        columns : dictionary
+            The up to date columns. The dictionary is replaced, not
+            modified, so it stays consistent for the caller.
+        """
+        with self._lock:
+            version = self.get_version()
+            if not self.loaded or version != self.version:
+                self.last_id = None
+                self.columns = to_columns([], self.fields)
+                self.version = version
+                self.loaded = True
+            query = {} if self.last_id is None else {'_id': {'$gt': self.last_id}}
+            projection = dict((field, 1) for field in self.fields)
+            new = list(self.collection.find(query, projection).sort('_id', ASCENDING))
+            if new:
+                new = to_columns(new, self.fields)
+                self.columns = dict(
+                    (field, np.concatenate([self.columns[field], new[field]]))
+                    for field in self.columns)
+                self.last_id = new['_id'][-1]
+            return self.columns
+
+    def select(self, user_id, loid, day=None, date=None, sort_by_time=False):
+        """Row indexes of a user on a learning objective, in _id order
+
+        Parameters
+        ----------
+        user_id, loid : integer
+            Ids of the user and of the learning objective
+
+        day : integer, optional (default=None)
+            Only keep rows with this Days value
+
+        date : datetime, optional (default=None)
+            Only keep rows submitted on this date
+
+        sort_by_time : bool, optional (default=False)
+            Order the rows by SubmitDateTime instead of by _id
+
+        Returns
+        -------
+        columns : dictionary
+            The columns the indexes refer to
+
+        rows : ndarray
+            The selected row indexes
+        """
+        columns = self.refresh()
+        mask = ((columns['UserId'] == user_id) &
+                (columns['LearningObjectiveId'] == loid))
+        if day is not None:
+            mask &= columns['Days'] == day
+        if date is not None:
+            mask &= (columns['SubmitDateTime'].astype('datetime64[D]') ==
+                     np.datetime64(date, 'D'))
+        rows = np.where(mask)[0]
+        if sort_by_time:
+            rows = rows[np.argsort(columns['SubmitDateTime'][rows],
+                                   kind='mergesort')]
+        return columns, rows
+
+    def select_users(self, user_ids, loid, days=None, sort_by_time=False):
+        """select for several users, with one refresh and one mask
+
+        days is a list of Days values to keep, None keeps every day.
+
+        Returns
+        -------
+        columns : dictionary
+            The columns the indexes refer to
+
+        rows : dictionary
+            Maps every user id with submissions to its row indexes, in _id
+            order or by SubmitDateTime when sort_by_time is set
+        """
+        columns = self.refresh()
+        mask = (np.isin(columns['UserId'], list(user_ids)) &
+                (columns['LearningObjectiveId'] == loid))
+        if days is not None:
+            mask &= np.isin(columns['Days'], list(days))
+        selected = np.where(mask)[0]
+        if sort_by_time:
+            selected = selected[np.argsort(columns['SubmitDateTime'][selected],
+                                           kind='mergesort')]
+        rows = {}
+        for i in selected:
+            rows.setdefault(columns['UserId'][i], []).append(i)
+        return columns, rows
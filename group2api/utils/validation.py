@@ -0,0 +1,103 @@
+from datetime import datetime
+
+import pandas as pd
+
+
+SUBMIT_DATETIME_FORMATS = ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']
+
+
+def parse_submit_datetime(value):
+    """Parse a SubmitDateTime value
+
+    Parameters
+    ----------
+    value : string or datetime,
+        Either a datetime or a string in one of SUBMIT_DATETIME_FORMATS
+
+    Returns
+    -------
+    date_time : datetime
+
+    Raises
+    ------
+    ValueError
+        If the value is not a valid submission time
+    """
+    if isinstance(value, datetime):
+        return value
+    for fmt in SUBMIT_DATETIME_FORMATS:
+        try:
+            return datetime.strptime(str(value), fmt)
+        except ValueError:
+            pass
+    raise ValueError("SubmitDateTime {!r} is not in YYYY-MM-DD HH:MM:SS[.fff] "
+                     "format".format(value))
+
+
+def format_submit_datetime(date_time):
+    """The string form of a SubmitDateTime, as the clients send it"""
+    return date_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def to_datetime64(values):
+    """Convert many SubmitDateTime values at once
+
+    Parameters
+    ----------
+    values : array-like,
+        datetimes or strings in SUBMIT_DATETIME_FORMATS, mixed is fine
+
+    Returns
+    -------
+    dates : DatetimeIndex or Series
+        NaT where a value is missing or invalid
+    """
+    if int(pd.__version__.split('.')[0]) >= 2:
+        # pandas 2 guesses a single format from the first value, which
+        # drops the times with (or without) fractional seconds
+        return pd.to_datetime(values, errors='coerce', format='ISO8601')
+    return pd.to_datetime(values, errors='coerce')
+
+
+def to_int(value, field):
+    """Convert value to an int, refusing non integral numbers"""
+    try:
+        number = float(value)
+        if number != int(number):
+            raise ValueError
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("{} {!r} is not an integer".format(field, value))
+    return int(number)
+
+
+def coerce_submission(item):
+    """Validate a posted submission and convert its fields to their types
+
+    UserId and Correct become ints, SubmitDateTime becomes a datetime so
+    it is stored as a BSON date. Other fields are kept as they are.
+
+    Parameters
+    ----------
+    item : dictionary,
+        One posted submission
+
+    Returns
+    -------
+    submission : dictionary
+        A converted copy of the item
+
+    Raises
+    ------
+    ValueError
+        If a field is missing or can not be converted
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Row should be a dictionary")
+    submission = dict(item)
+    for field in ['UserId', 'Correct', 'SubmitDateTime']:
+        if field not in submission:
+            raise ValueError("Missing field {}".format(field))
+    submission['UserId'] = to_int(submission['UserId'], 'UserId')
+    submission['Correct'] = to_int(submission['Correct'], 'Correct')
+    submission['SubmitDateTime'] = parse_submit_datetime(submission['SubmitDateTime'])
+    return submission